@@ -1,6 +1,7 @@
-from cloud import connect, manage, config, name, command
+from cloud import connect, api, manage, config, name, command, probe, schedule, timings
 
 from boto.exception import BotoServerError
+import threading
 
 # Logging
 from cloud.logger import logger, notify
@@ -8,55 +9,75 @@ logger = logger(__name__)
 import logging
 logger = logging.getLogger(__name__)
 
+# Held while checking for (and possibly baking) the app image.
+image_lock = threading.Lock()
+
 DEFAULT_INSTANCE_TYPE='m3.medium'
 TEMPLATES = ['global', 'bucket', 'api', 'front', 'database', 'knowledge', 'collector']
 
-def update(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_instance_type='db.m1.medium', knowledge_instance_type='m3.large', collector_instance_type='c3.large', db_size=250):
-    conn = connect.cf()
+# Roles which include the app (and so run migrations),
+# and what each role needs to be deployed before it.
+APP_ROLES = ['api', 'front', 'collector']
+ROLE_DEPENDENCIES = {
+    'api': ['knowledge'],
+    'front': ['knowledge'],
+    'collector': ['knowledge']
+}
+
+# Stack outputs for the hosts which are added to known hosts.
+HOST_OUTPUTS = ['KnowledgePublicIP', 'KnowledgePublicDNS', 'APIServerPublicIP', 'APIServerPublicDNS', 'FrontServerPublicIP', 'FrontServerPublicDNS', 'CollectorPublicIP', 'CollectorPublicDNS']
+
+def update(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_instance_type='db.m1.medium', knowledge_instance_type='m3.large', collector_instance_type='c3.large', db_size=250, force=False, nested=False):
     app = config.APP_NAME
     stack_name = name.stack(app, env)
     img_name = name.image(app)
 
     logger.info('Updating application cloud (app={0}, stack_name={1}, image_name={2})...'.format(app, stack_name, img_name))
 
-    stacks = [stack for stack in conn.describe_stacks() if stack.stack_name == stack_name]
-    if len(stacks) == 0:
+    stack = manage.formations.get_stack(stack_name)
+    if stack is None:
         logger.info('Infrastructure doesn\'t exist yet. Please commission it first.')
         return
 
-    app_ami_id = get_or_create_image(img_name)
+    app_ami_ids = get_or_create_image(img_name)
 
     logger.info('UPDATING INFRASTRUCTURE ===================================================')
     logger.info('Merging individual templates: {0}'.format(TEMPLATES))
-    template = manage.formations.build_template(TEMPLATES)
+    template = manage.formations.build_template(TEMPLATES, nested=nested)
 
-    parameters = build_parameters(env, app, app_ami_id, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type)
+    parameters = build_parameters(env, app, app_ami_ids, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type)
 
-    logger.info('Updating the infrastructure...')
-    logger.info('You can see its progress (and debug issues more easily) by checking out [https://console.aws.amazon.com/cloudformation/]')
+    plan = manage.plan.plan(stack, template, parameters)
+    if manage.formations.is_nested(plan.deployed) != nested:
+        logger.info('The infrastructure was commissioned {0} nested stacks. Switching would replace every resource (including the database), so update it {0} `--nested`.'.format('without' if nested else 'with'))
+        return
+    plan.log()
 
-    try:
-        conn.update_stack(
-                stack_name,
-                template,
-                parameters=parameters
-        )
-    except BotoServerError as e:
-        if e.message == 'No updates are to be performed.':
-            logger.info('There are no updates to make! If you wish to deploy non-infrastructural updates, use the `deploy` command.')
-            return
-        else:
-            raise e
+    if not plan.changed and not force:
+        logger.info('Skipping straight to configuration. To push the infrastructure anyway (e.g. for NoEcho parameters), use `--force`.')
+    else:
+        logger.info('Updating the infrastructure...')
+        logger.info('You can see its progress (and debug issues more easily) by checking out [https://console.aws.amazon.com/cloudformation/]')
 
-    try:
-        manage.formations.wait_until_ready(stack_name)
+        try:
+            manage.formations.update_stack(
+                    stack_name,
+                    template,
+                    parameters
+            )
+            manage.formations.wait_until_ready(stack_name)
 
-    except manage.formations.FormationError as e:
-        logger.info('There was an error updating the infrastructure: {0}'.format(e.message))
-        logger.info('If the stack was rolled back, it is likely due to an error with the template.')
-        logger.info('Cleaning up...')
-        manage.formations.wait_until_rolled_back(stack_name)
-        return
+        except BotoServerError as e:
+            if e.message != 'No updates are to be performed.':
+                raise e
+            logger.info('CloudFormation found no updates to make.')
+
+        except manage.formations.FormationError as e:
+            logger.info('There was an error updating the infrastructure: {0}'.format(e.message))
+            logger.info('If the stack was rolled back, it is likely due to an error with the template.')
+            logger.info('Cleaning up...')
+            manage.formations.wait_until_rolled_back(stack_name)
+            return
 
     # Return the output from the stack creation.
     stack = manage.formations.get_stack(stack_name)
@@ -64,10 +85,11 @@ def update(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_
     logger.info('UPDATING INFRASTRUCTURE =================================================== DONE')
 
     logger.info('CONFIGURING INFRASTRUCTURE ================================================')
-    logger.info('Adding instances to known hosts...')
-    targets = [manage.formations.get_output(stack, key) for key in ['KnowledgePublicIP', 'KnowledgePublicDNS', 'APIServerPublicIP', 'APIServerPublicDNS', 'FrontServerPublicIP', 'FrontServerPublicDNS', 'CollectorPublicIP', 'CollectorPublicDNS']]
-    print(targets)
-    command.add_to_known_hosts(targets)
+    if not wait_for_ssh(stack):
+        return
+
+    if not add_to_known_hosts(stack):
+        return
 
     deploy(env)
     logger.info('CONFIGURING INFRASTRUCTURE ================================================ DONE')
@@ -78,31 +100,30 @@ def update(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_
     notify.notify('Updating for [{0}] complete.'.format(env))
     return stack.outputs
 
-def commission(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_instance_type='db.m1.medium', knowledge_instance_type='m3.large', collector_instance_type='c3.large', db_size=250):
-    conn = connect.cf()
+def commission(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE, db_instance_type='db.m1.medium', knowledge_instance_type='m3.large', collector_instance_type='c3.large', db_size=250, nested=False):
     app = config.APP_NAME
     stack_name = name.stack(app, env)
     img_name = name.image(app)
 
     logger.info('Commissioning new application cloud (app={0}, stack_name={1}, image_name={2})...'.format(app, stack_name, img_name))
 
-    app_ami_id = get_or_create_image(img_name)
+    app_ami_ids = get_or_create_image(img_name)
 
     logger.info('SPAWNING INFRASTRUCTURE ===================================================')
     if manage.formations.get_stack(stack_name) is not None:
         logger.info('Infrastructure for the environment [{0}] already exists.'.format(env))
     else:
         logger.info('Merging individual templates: {0}'.format(TEMPLATES))
-        template = manage.formations.build_template(TEMPLATES)
+        template = manage.formations.build_template(TEMPLATES, nested=nested)
 
-        parameters = build_parameters(env, app, app_ami_id, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type)
+        parameters = build_parameters(env, app, app_ami_ids, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type)
 
         logger.info('Creating the infrastructure...')
         logger.info('You can see its progress (and debug issues more easily) by checking out [https://console.aws.amazon.com/cloudformation/]')
-        conn.create_stack(
+        manage.formations.create_stack(
                 stack_name,
                 template,
-                parameters=parameters
+                parameters
         )
 
         try:
@@ -122,9 +143,11 @@ def commission(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE,
     logger.info('SPAWNING INFRASTRUCTURE =================================================== DONE')
 
     logger.info('CONFIGURING INFRASTRUCTURE ================================================')
-    logger.info('Adding instances to known hosts...')
-    targets = [manage.formations.get_output(stack, key) for key in ['KnowledgePublicIP', 'KnowledgePublicDNS', 'APIServerPublicIP', 'APIServerPublicDNS', 'FrontServerPublicIP', 'FrontServerPublicDNS', 'CollectorPublicIP', 'CollectorPublicDNS']]
-    command.add_to_known_hosts(targets)
+    if not wait_for_ssh(stack):
+        return
+
+    if not add_to_known_hosts(stack):
+        return
 
     deploy(env)
     logger.info('CONFIGURING INFRASTRUCTURE ================================================ DONE')
@@ -136,28 +159,82 @@ def commission(env, min_size=1, max_size=4, instance_type=DEFAULT_INSTANCE_TYPE,
     return stack.outputs
 
 def decommission(env):
-    conn = connect.cf()
     app = config.APP_NAME
     stack_name = name.stack(app, env)
 
-    stacks = [stack for stack in conn.describe_stacks() if stack.stack_name == stack_name]
-    if len(stacks) == 0:
+    if manage.formations.get_stack(stack_name) is None:
         logger.info('Infrastructure is already decommissioned.')
         return
 
     logger.info('Decommissioning...')
-    conn.delete_stack(stack_name)
+    manage.formations.delete_stack(stack_name)
     manage.formations.wait_until_terminated(stack_name)
     logger.info('Decommissioning complete.')
     notify.notify('Decommissioning for [{0}] complete.'.format(env))
 
-def deploy(env, roles=['knowledge', 'api', 'front', 'collector']):
+def deploy(env, roles=['knowledge', 'api', 'front', 'collector'], force=False, rolling=False, batch_size=1, max_unavailable=1):
+    """
+    Deploys the roles, running the playbooks for roles
+    which don't depend on one another concurrently.
+
+    If `rolling` is set, roles in a load balanced autoscaling
+    group are deployed in batches (see `manage.rolling`).
+
+    Roles whose inputs haven't changed since they were
+    last deployed are skipped, unless `force` is set.
+
+    Database migrations are only run by the first
+    app role, rather than by each of them, and the
+    other app roles wait until it has run them.
+    """
     app = config.APP_NAME
     key_name = config.KEY_NAME
 
-    for playbook in roles:
+    git_sha = manage.deploys.git_sha()
+    deployed = manage.deploys.get_fingerprints(env)
+    fingerprints = dict((role, manage.deploys.fingerprint(app, env, role, git_sha,
+                                                          dependencies=ROLE_DEPENDENCIES.get(role, []),
+                                                          database=role in APP_ROLES)) for role in roles)
+
+    skipped = []
+    if not force:
+        skipped = [role for role in roles if fingerprints[role] is not None and fingerprints[role] == deployed.get(role)]
+        for role in skipped:
+            logger.info('Skipping [{0}], nothing has changed since it was last deployed.'.format(role))
+    changed = [role for role in roles if role not in skipped]
+
+    migrator = next((role for role in APP_ROLES if role in changed), None)
+
+    # The other app roles mustn't restart onto an unmigrated schema.
+    dependencies = dict((role, list(deps)) for role, deps in ROLE_DEPENDENCIES.items())
+    for role in APP_ROLES:
+        if role in changed and role != migrator:
+            dependencies.setdefault(role, []).append(migrator)
+
+    def provision(playbook):
         logger.info('Configuring with playbook [{0}]'.format(playbook))
-        manage.provision.provision(app, playbook, key_name, env=env)
+        extra_vars = {}
+        if playbook in APP_ROLES:
+            extra_vars['run_migrations'] = 'yes' if playbook == migrator else 'no'
+
+        group = manage.rolling.get_group(app, env, playbook) if rolling else None
+        if group is not None:
+            manage.rolling.roll(group, app, playbook, key_name, env, extra_vars=extra_vars, batch_size=batch_size, max_unavailable=max_unavailable, prefix=playbook)
+        else:
+            manage.provision.provision(app, playbook, key_name, env=env, extra_vars=extra_vars, prefix=playbook)
+        manage.deploys.record(env, playbook, fingerprints[playbook])
+
+    results = dict((result.name, result) for result in schedule.run_graph(changed, dependencies, provision))
+    for role in skipped:
+        results[role] = schedule.Result(role)
+        results[role].status = 'skipped'
+        results[role].note = 'unchanged'
+    results = [results[role] for role in roles]
+    schedule.summarize('deploy', results, label='role')
+
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        raise Exception('Deployment for [{0}] failed for: {1}'.format(env, ', '.join(failed)))
 
     notify.notify('Deployment for [{0}] complete.'.format(env))
 
@@ -171,24 +248,88 @@ def clean():
     manage.images.delete_image(img_name)
 
 
+def pool(size):
+    """
+    Refills and trims the warm pool of image instances.
+    """
+    img_name = name.image(config.APP_NAME)
+    manage.images.trim_pool(img_name, config.BASE_AMI, size)
+    manage.images.refill_pool(img_name, config.APP_NAME, config.BASE_AMI, config.KEY_NAME, size)
+
 def get_or_create_image(img_name):
-    # Get the app image.
-    logger.info('CHECKING IMAGE ============================================================')
-    app_ami_id = manage.images.get_image(img_name)
-
-    if app_ami_id is None:
-        # CREATE if it doesnt exist
-        logger.info('Existing app image wasn\'t found, creating one...')
-        logger.info('BAKING IMAGE ==============================================================')
-        manage.images.create_image_instance(img_name, config.BASE_AMI, config.KEY_NAME)
-        manage.images.configure_image_instance(img_name, app, config.KEY_NAME)
-        app_ami_id = manage.images.create_image(img_name)
-        logger.info('BAKING IMAGE ============================================================== DONE')
-    logger.info('CHECKING IMAGE ============================================================ DONE')
-
-    return app_ami_id
-
-def build_parameters(env, app, app_ami_id, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type):
+    """
+    Gets (baking if necessary) the app image,
+    returning a dict of region to AMI id.
+    """
+    # Environments operated on concurrently share the image,
+    # so only one of them bakes it while the others wait on it.
+    with image_lock:
+        # Get the app image for the current fingerprint.
+        logger.info('CHECKING IMAGE ============================================================')
+        fingerprint = manage.images.fingerprint(config.BASE_AMI)
+        logger.info('Image fingerprint: {0}'.format(fingerprint))
+        app_ami_id = manage.images.get_image(img_name, fingerprint)
+
+        if app_ami_id is None:
+            # CREATE if it doesnt exist
+            logger.info('Existing app image wasn\'t found, creating one...')
+            logger.info('BAKING IMAGE ==============================================================')
+            instance = manage.images.start_from_pool(img_name, config.BASE_AMI)
+            if instance is not None:
+                # Pool instances are already provisioned,
+                # so configuring them only applies what changed.
+                try:
+                    manage.images.configure_image_instance(img_name, config.APP_NAME, config.KEY_NAME)
+                    app_ami_id = manage.images.create_image(img_name, fingerprint, instance=instance)
+                finally:
+                    manage.images.return_to_pool(instance)
+            else:
+                manage.images.create_image_instance(img_name, config.BASE_AMI, config.KEY_NAME)
+                manage.images.configure_image_instance(img_name, config.APP_NAME, config.KEY_NAME)
+                app_ami_id = manage.images.create_image(img_name, fingerprint)
+            logger.info('BAKING IMAGE ============================================================== DONE')
+        else:
+            manage.images.touch_image(app_ami_id)
+
+        # Copy it to any other regions it's needed in.
+        regions = getattr(config, 'IMAGE_REGIONS', [])
+        app_ami_ids = manage.images.replicate_image(img_name, app_ami_id, fingerprint, regions)
+
+        keep = getattr(config, 'IMAGE_RETENTION', manage.images.DEFAULT_IMAGE_RETENTION)
+        for region in app_ami_ids:
+            manage.images.evict_images(img_name, keep=keep, region=region)
+        logger.info('CHECKING IMAGE ============================================================ DONE')
+
+    return app_ami_ids
+
+def wait_for_ssh(stack):
+    """
+    Waits until the stack's hosts accept SSH connections,
+    so that provisioning starts as soon as it can (but no sooner).
+    """
+    logger.info('Waiting for SSH to become active...')
+    hosts = manage.formations.get_outputs(stack, [key for key in HOST_OUTPUTS if key.endswith('PublicIP')])
+    results = probe.wait_for_ssh(hosts)
+    unreachable = [host for host, ok in results.items() if not ok]
+    if unreachable:
+        logger.info('Could not reach {0} over SSH. Once they are up, try the `deploy` command.'.format(', '.join(unreachable)))
+        return False
+    return True
+
+def add_to_known_hosts(stack):
+    """
+    Adds the stack's hosts to known hosts,
+    so that they can be provisioned.
+    """
+    logger.info('Adding instances to known hosts...')
+    results = command.add_to_known_hosts(manage.formations.get_outputs(stack, HOST_OUTPUTS))
+    failed = [host for host, ok in results.items() if not ok]
+    if failed:
+        logger.info('Could not get the keys for {0}. Once they are up, try the `deploy` command.'.format(', '.join(failed)))
+        return False
+    return True
+
+def build_parameters(env, app, app_ami_ids, instance_type, knowledge_instance_type, collector_instance_type, db_size, db_instance_type):
     parameters = [
         # Refer to the formation JSON templates for
         # details on these parameters.
@@ -208,7 +349,7 @@ def build_parameters(env, app, app_ami_id, instance_type, knowledge_instance_typ
         #('APIMinSize', min_size),
         #('APIMaxSize', max_size),
 
-        ('AppImageAMI', app_ami_id),
+        ('AppImageAMI', app_ami_ids[config.REGION]),
 
         # Knowledge
         ('KnowledgeInstanceType', knowledge_instance_type),
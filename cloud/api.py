@@ -0,0 +1,214 @@
+"""
+API
+==============
+
+Wraps AWS API calls.
+
+Connections from `cloud.connect` are wrapped in a
+`Client`, so that every call through them:
+
+* waits on a client-side token bucket for its service,
+  so that concurrent operations (e.g. commissioning several
+  environments at once) don't set off AWS's throttling;
+* is retried, backing off exponentially with jitter,
+  if it is throttled anyway or (if it only reads,
+  see `IDEMPOTENT_PREFIXES`) hits a transient error;
+* is counted and timed per operation, so we can
+  see which calls (and how many) an operation makes.
+"""
+
+import time, random, socket, threading
+
+from boto.exception import BotoServerError
+
+import logging
+logger = logging.getLogger(__name__)
+
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown', 'TooManyRequestsException']
+TRANSIENT_CODES = ['InternalError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException']
+
+# Operations which are safe to retry after a transient error,
+# since they don't change anything. Other operations (e.g.
+# `create_stack` or `copy_image`) may have gone through even if
+# their response was lost, so they're only retried when throttled.
+IDEMPOTENT_PREFIXES = ('describe_', 'get_', 'list_', 'lookup')
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+
+# Sustained calls per second (and bursts) allowed per service.
+# CloudFormation's limits are much lower than the rest.
+RATES = {
+    'cloudformation': (2, 5),
+    'ec2': (10, 20),
+    'autoscale': (5, 10),
+    'elb': (5, 10),
+    'rds': (5, 10),
+    's3': (50, 100)
+}
+DEFAULT_RATE = (5, 10)
+
+# Upper bounds (in seconds) of the latency histogram's buckets.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls per second on average,
+    in bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one if need be.
+        Returns how long (in seconds) it waited.
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class Stats(object):
+    """
+    Counts and times an operation's calls.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.waited = 0
+        self.total = 0
+        self.max = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, latency):
+        self.calls += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.histogram[i] += 1
+                break
+
+_buckets = {}
+_stats = {}
+_lock = threading.Lock()
+
+def bucket(service):
+    with _lock:
+        if service not in _buckets:
+            _buckets[service] = TokenBucket(*RATES.get(service, DEFAULT_RATE))
+        return _buckets[service]
+
+def record(service, operation, **kwargs):
+    """
+    Records a call (with its `latency`), an error,
+    a retry, a throttle or time spent `waited`.
+    """
+    with _lock:
+        stats = _stats.setdefault((service, operation), Stats())
+        if 'latency' in kwargs:
+            stats.observe(kwargs['latency'])
+        for key in ['errors', 'retries', 'throttles', 'waited']:
+            setattr(stats, key, getattr(stats, key) + kwargs.get(key, 0))
+
+def is_throttle(error):
+    return isinstance(error, BotoServerError) and (error.error_code in THROTTLE_CODES or error.status == 429)
+
+def is_transient(error):
+    if isinstance(error, BotoServerError):
+        return error.error_code in TRANSIENT_CODES or (error.status is not None and error.status >= 500)
+    return isinstance(error, (socket.error, socket.timeout))
+
+def is_idempotent(operation):
+    return operation.startswith(IDEMPOTENT_PREFIXES)
+
+def call(service, operation, func, *args, **kwargs):
+    """
+    Calls `func`, waiting on the service's token bucket,
+    and retrying (with backoff) throttled errors, and
+    transient errors if the operation is idempotent.
+    """
+    attempt = 0
+    while True:
+        record(service, operation, waited=bucket(service).acquire())
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+            record(service, operation, latency=time.time() - started)
+            return result
+        except Exception as e:
+            record(service, operation, latency=time.time() - started, errors=1)
+            throttled = is_throttle(e)
+            attempt += 1
+            if not (throttled or (is_transient(e) and is_idempotent(operation))) or attempt >= MAX_ATTEMPTS:
+                raise
+
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+            record(service, operation, retries=1, throttles=1 if throttled else 0)
+            logger.info('{0}.{1} {2} ({3}), retrying in {4:.1f}s...'.format(service, operation, 'throttled' if throttled else 'failed', e, delay))
+            time.sleep(delay)
+
+class Client(object):
+    """
+    Wraps a boto connection, so that each
+    of its methods is called through `call`.
+    """
+
+    def __init__(self, conn, service):
+        self._conn = conn
+        self._service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        def wrapped(*args, **kwargs):
+            return call(self._service, name, attr, *args, **kwargs)
+        wrapped.__name__ = name
+        return wrapped
+
+def stats():
+    """
+    Gets each operation's `Stats`, keyed by `(service, operation)`.
+    """
+    with _lock:
+        return dict(_stats)
+
+def log_stats():
+    """
+    Logs how many calls each operation made,
+    how long they took, and how many were retried.
+    """
+    all_stats = sorted(stats().items())
+    if not all_stats:
+        return
+
+    width = max(len('operation'), max(len('{0}.{1}'.format(service, operation)) for (service, operation), _ in all_stats))
+    buckets = ' '.join('<={0:g}s'.format(bound) if bound != float('inf') else '>{0:g}s'.format(LATENCY_BUCKETS[-2]) for bound in LATENCY_BUCKETS)
+    rows = ['{0}  {1:>6}  {2:>6}  {3:>7}  {4:>8}  {5:>8}  {6:>8}  latencies ({7})'.format('operation'.ljust(width), 'calls', 'errors', 'retries', 'waited', 'mean', 'max', buckets)]
+    calls = 0
+    for (service, operation), s in all_stats:
+        calls += s.calls
+        rows.append('{0}  {1:>6}  {2:>6}  {3:>7}  {4:>7.1f}s  {5:>7.2f}s  {6:>7.2f}s  {7}'.format(
+            '{0}.{1}'.format(service, operation).ljust(width), s.calls, s.errors, s.retries, s.waited,
+            s.total / s.calls if s.calls else 0, s.max, ' '.join(str(n) for n in s.histogram)))
+    logger.info('AWS API calls ({0} in total):\n{1}'.format(calls, '\n'.join(rows)))
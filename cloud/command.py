@@ -5,48 +5,329 @@ Command
 Interface for commanding the cloud.
 """
 
-import subprocess, time, os
+import subprocess, time, os, sys, select, itertools, threading
+import hmac, hashlib, base64
+from collections import deque
+
+from cloud.logger import logs_path
 
 import logging
 logger = logging.getLogger(__name__)
 
-def cmd(cmd, log=False):
+# Where each command's full output is logged.
+COMMAND_LOGS_PATH = os.path.join(logs_path, 'commands')
+
+# How many command logs are kept around.
+COMMAND_LOG_RETENTION = 100
+
+# How many lines of output are kept
+# in memory (e.g. for error reports).
+TAIL_LINES = 200
+
+# How much is read from a process at a time.
+READ_SIZE = 64 * 1024
+
+# How long a partial line may get before it's output anyway.
+MAX_LINE = 64 * 1024
+
+# Held while writing to the console, so output
+# from concurrent commands doesn't interleave mid-line.
+_console_lock = threading.Lock()
+_log_ids = itertools.count(1)
+
+KNOWN_HOSTS = os.path.expanduser('~/.ssh/known_hosts')
+
+# How long (in seconds) to wait on each host's keys.
+KEYSCAN_TIMEOUT = 10
+
+# Held while rewriting known hosts, since
+# environments are operated on concurrently.
+_known_hosts_lock = threading.Lock()
+
+class Stream(object):
+    """
+    A running process, whose output is teed to the console,
+    its own log file, and a ring buffer of its last lines.
+    """
+
+    def __init__(self, cmd, prefix=None, env=None):
+        self.cmd = cmd
+        self.prefix = '[{0}] '.format(prefix).encode('utf-8') if prefix is not None else b''
+        self.tail = deque(maxlen=TAIL_LINES)
+        self.partial = b''
+        self.proc = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, env=env)
+        self.fd = self.proc.stdout.fileno()
+        self.log_path = command_log_path(cmd, prefix)
+        self.log_file = open(self.log_path, 'wb')
+
+    def feed(self, chunk):
+        """
+        Handles a chunk of output.
+        An empty chunk means the output has ended.
+        """
+        self.log_file.write(chunk)
+
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        if not chunk or len(self.partial) > MAX_LINE:
+            if self.partial:
+                lines.append(self.partial)
+            self.partial = b''
+
+        if lines:
+            self.tail.extend(line.decode('utf-8', 'replace') for line in lines)
+            write(b''.join(self.prefix + line + b'\n' for line in lines))
+
+    def finish(self):
+        """
+        Waits for the process to exit, returning the tail of its output.
+        """
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        self.log_file.close()
+        output = '\n'.join(self.tail)
+
+        # Raise an exception if the command exited
+        # with a non-zero code.
+        if returncode != 0:
+            logger.error('Command exited with {0}, its full output is in {1}'.format(returncode, self.log_path))
+            error = subprocess.CalledProcessError(returncode, self.cmd, output=output)
+            error.log_path = self.log_path
+            raise error
+        return output
+
+def cmd(cmd, log=False, prefix=None, env=None):
     """
     Convenience method for calling a process and getting its results.
 
-    This prints output of the process realtime and stores it in a variable for return.
-    It's a bit hacky; stderr is redirected to stdout which itself is piped, so
-    both the error and output streams go to the same place. This isn't ideal, but
-    treating them separately is tricky because, for instance, if nothing is being sent
-    to stderr, and it redirects to its own pipe, then it will block the process.
+    Output is streamed as it comes in: it is printed, written in full to
+    a log file in `cloud/logger/logs/commands/`, and the last `TAIL_LINES`
+    lines are kept in memory and returned. If the process fails, that tail
+    is attached to the raised `CalledProcessError` (as `output`) along with
+    the log's path (as `log_path`).
+
+    stderr is redirected to stdout, so both the error and
+    output streams go to the same place.
 
     Args:
         | cmd (list)    -- list of args for the command.
+        | prefix (str)  -- prefix for each line of output.
+        | env (dict)    -- environment for the process (defaults to ours).
+    """
+    return cmds([cmd], prefixes=[prefix], env=env)[0]
+
+def cmds(cmds, prefixes=None, env=None):
+    """
+    Runs several processes concurrently, prefixing
+    each line of output with its command's prefix.
+
+    All of the processes' output is read from a single
+    loop: pipes are only read from when `select` says
+    they have output, so no read blocks on a quiet process.
+
+    Returns the tail of each command's output; if any
+    fail, the first failure's `CalledProcessError` is
+    raised once they've all exited.
+    """
+    prefixes = prefixes or [None] * len(cmds)
+    streams = []
+    try:
+        for cmd, prefix in zip(cmds, prefixes):
+            streams.append(Stream(cmd, prefix, env))
+    except Exception:
+        for stream in streams:
+            stream.proc.kill()
+            stream.proc.wait()
+            stream.log_file.close()
+        raise
+
+    running = dict((stream.fd, stream) for stream in streams)
+    while running:
+        readable, _, _ = select.select(list(running), [], [])
+        for fd in readable:
+            chunk = os.read(fd, READ_SIZE)
+            running[fd].feed(chunk)
+            if not chunk:
+                del running[fd]
+
+    outputs, errors = [], []
+    for stream in streams:
+        try:
+            outputs.append(stream.finish())
+        except subprocess.CalledProcessError as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return outputs
+
+def write(data):
+    """
+    Writes (encoded) output to the console.
     """
-    proc = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    output = b''
-    while proc.poll() is None:
-        line = proc.stdout.readline()
-        print(line.decode('utf-8'))
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    with _console_lock:
+        out.write(data)
+        out.flush()
 
-    # Captures any missed output.
-    # Note that because we are redirecting stderr to stdout,
-    # `err` will be None; its output is included in `out`.
-    out, err = proc.communicate()
+def command_log_path(cmd, prefix=None):
+    """
+    Creates a path for a command's log,
+    pruning the oldest logs beyond `COMMAND_LOG_RETENTION`.
+    """
+    if not os.path.exists(COMMAND_LOGS_PATH):
+        os.makedirs(COMMAND_LOGS_PATH)
 
-    # Raise an exception if the command exited
-    # with a non-zero code.
-    if proc.returncode != 0:
-        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    logs = sorted(os.listdir(COMMAND_LOGS_PATH))
+    for filename in logs[:max(0, len(logs) - COMMAND_LOG_RETENTION + 1)]:
+        try:
+            os.remove(os.path.join(COMMAND_LOGS_PATH, filename))
+        except OSError:
+            pass
 
-def add_to_known_hosts(hosts):
+    name = prefix or os.path.basename(cmd[0])
+    filename = '{0}-{1}-{2:06d}-{3}.log'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), next(_log_ids), name.replace(' ', '_').replace('/', '_'))
+    return os.path.join(COMMAND_LOGS_PATH, filename)
+
+def add_to_known_hosts(hosts, timeout=KEYSCAN_TIMEOUT, path=KNOWN_HOSTS):
     """
-    Adds a list of hosts to known hosts.
+    Adds hosts' keys to known hosts, replacing any keys
+    already there for them (e.g. from a previous instance
+    which had the same address).
+
+    The hosts are scanned concurrently and known
+    hosts is rewritten once, atomically.
+
+    Returns a dict of host to whether its keys were added.
     """
-    known_hosts = open(os.path.expanduser('~/.ssh/known_hosts'), 'a')
+    hosts = list(hosts)
+    logger.info('Adding {0} to known hosts...'.format(', '.join(hosts)))
+    keys = keyscan(hosts, timeout)
+
+    with _known_hosts_lock:
+        known_hosts = KnownHosts(path)
+        for host, host_keys in keys.items():
+            known_hosts.replace(host, host_keys)
+        known_hosts.save()
+
+    results = dict((host, host in keys) for host in hosts)
+    for host, ok in results.items():
+        if not ok:
+            logger.warning('Couldn\'t get the keys for {0}.'.format(host))
+    return results
+
+def keyscan(hosts, timeout=KEYSCAN_TIMEOUT):
+    """
+    Scans hosts for their public keys.
+
+    `ssh-keyscan` scans all of the hosts at once,
+    giving up on each after `timeout` seconds.
+
+    Returns a dict of host to its known hosts lines,
+    for the hosts which answered.
+    """
+    if not hosts:
+        return {}
+
     devnull = open(os.devnull, 'w')
-    for host in hosts:
-        logger.info('Adding {0} to known hosts...'.format(host))
-        subprocess.Popen(['ssh-keyscan', '-p', '22', host], stdout=known_hosts, stderr=devnull)
-    known_hosts.close()
-    devnull.close()
+    try:
+        proc = subprocess.Popen(['ssh-keyscan', '-T', str(timeout), '-p', '22'] + list(hosts), stdout=subprocess.PIPE, stderr=devnull)
+        out, _ = proc.communicate()
+    finally:
+        devnull.close()
+
+    keys = {}
+    for line in out.decode('utf-8', 'replace').splitlines():
+        parts = line.split()
+        if len(parts) < 3 or line.startswith('#'):
+            continue
+        keys.setdefault(parts[0], []).append(line)
+    return keys
+
+class KnownHosts(object):
+    """
+    A known hosts file, indexed by host.
+
+    Hashed entries are matched too, so keys added
+    with `ssh-keyscan -H` are replaced as well.
+    """
+
+    def __init__(self, path=KNOWN_HOSTS):
+        self.path = path
+        self.lines = []
+        self.index = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f.read().splitlines():
+                    self.add(line)
+
+    def add(self, line):
+        self.lines.append(line)
+        for pattern in patterns(line):
+            self.index.setdefault(pattern, set()).add(len(self.lines) - 1)
+
+    def find(self, host):
+        """
+        Gets the indices of the lines with keys for a host.
+        """
+        found = set(self.index.get(host, set()))
+        for pattern, indices in self.index.items():
+            if pattern.startswith('|1|') and hashed_match(pattern, host):
+                found |= indices
+        return found
+
+    def replace(self, host, lines):
+        """
+        Replaces a host's keys.
+        """
+        for i in self.find(host):
+            line = self.lines[i]
+            if line is None:
+                continue
+            remaining = [pattern for pattern in patterns(line) if pattern != host and not hashed_match(pattern, host)]
+            if remaining:
+                # The line is for other hosts too; just drop this one.
+                rest = line.split(None, 1)[1]
+                self.lines[i] = '{0} {1}'.format(','.join(remaining), rest)
+            else:
+                self.lines[i] = None
+        for line in lines:
+            self.add(line)
+
+    def save(self):
+        """
+        Writes the file atomically, so it's never
+        seen (e.g. by ssh) half-written.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            for line in self.lines:
+                if line is not None:
+                    f.write(line + '\n')
+        os.chmod(tmp_path, 0o600)
+        os.rename(tmp_path, self.path)
+
+def patterns(line):
+    """
+    Gets the host patterns a known hosts line is for
+    (none for comments and marked, e.g. @revoked, lines).
+    """
+    if not line.strip() or line.startswith('#') or line.startswith('@'):
+        return []
+    return line.split(None, 1)[0].split(',')
+
+def hashed_match(pattern, host):
+    """
+    Whether a hashed (`|1|salt|hash`) pattern is for a host.
+    """
+    if not pattern.startswith('|1|'):
+        return False
+    try:
+        salt, digest = pattern[3:].split('|')
+        expected = hmac.new(base64.b64decode(salt), host.encode('utf-8'), hashlib.sha1).digest()
+    except (ValueError, TypeError):
+        return False
+    return base64.b64encode(expected).decode('utf-8') == digest
@@ -10,19 +10,123 @@ values.
 
 The values are exported in uppercase form,
 i.e. 'git_repo' becomes `config.GIT_REPO`.
+
+The config is only loaded when a value is first
+accessed, and is found relative to this package
+(rather than the working directory). Loaded values
+are cached in `playbooks/.cache/config.pickle`, so
+that until `all.yml` changes (by its mtime and size)
+they're read from there, without parsing any YAML.
 """
 
-import yaml
-import os
+import os, sys, threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT, 'playbooks', 'group_vars', 'all.yml')
+CACHE_PATH = os.path.join(ROOT, 'playbooks', '.cache', 'config.pickle')
+
+# Bump to invalidate cached configs
+# (e.g. if how values are loaded changes).
+CACHE_VERSION = 1
+
+def load(path=CONFIG_PATH):
+    """
+    Loads the config's (uppercased) values,
+    from the cache if it's still fresh.
+    """
+    stat = os.stat(path)
+    key = (CACHE_VERSION, sys.version_info[0], stat.st_mtime, stat.st_size)
+
+    try:
+        with open(CACHE_PATH, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] == key:
+            return cached['values']
+    except Exception:
+        pass
+
+    values = compile_config(path)
+
+    try:
+        directory = os.path.dirname(CACHE_PATH)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file first, so a concurrent
+        # load never reads a half-written cache. The config
+        # has credentials in it, so only we can read it.
+        tmp_path = '{0}.{1}.tmp'.format(CACHE_PATH, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'key': key, 'values': values}, f, 2)
+        os.rename(tmp_path, CACHE_PATH)
+    except (IOError, OSError):
+        pass
+
+    return values
+
+def compile_config(path=CONFIG_PATH):
+    """
+    Parses the config, uppercasing its keys and
+    filling string values in with other values.
+    """
+    import yaml
+
+    # Load from Ansible's "global" vars.
+    c = yaml.load(open(path))
+
+    raw = dict((k.upper(), v) for (k, v) in c.items())
+    namespace = {}
+    for (k, v) in raw.items():
+        if isinstance(v, str):
+            namespace[k] = v.format(**raw)
+        else:
+            namespace[k] = v
+    return namespace
+
+class Config(object):
+    """
+    Stands in for this module, loading
+    the config when a value is first accessed.
+    """
+
+    def __init__(self, module):
+        self._module = module
+        self._values = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # The module's own attributes (e.g. `load`, `ROOT`).
+        if hasattr(self._module, name):
+            return getattr(self._module, name)
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    self._values = load()
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
 
-# Load from Ansible's "global" vars.
-c = yaml.load(open('playbooks/group_vars/all.yml'))
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._module, name, value)
 
-namespace = globals()
+    def reload(self):
+        """
+        Forgets the loaded values, so that
+        they're loaded again on next access.
+        """
+        self._values = None
 
-for (k, v) in c.items():
-    k = k.upper()
-    if isinstance(v, str):
-        namespace[k] = v.format(**globals())
-    else:
-        namespace[k] = v
+sys.modules[__name__] = Config(sys.modules[__name__])
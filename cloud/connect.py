@@ -12,22 +12,132 @@ from `~/.boto`, which should look something like::
     aws_access_key_id = YOURACCESSKEY
     aws_secret_access_key = YOURSECRETKEY
 
+Connections are memoized, keyed by service and
+region, so that repeated calls (e.g. on every tick
+of a waiter) reuse the same connection and its
+kept-alive HTTP connections rather than building
+a new one (and resolving credentials) each time.
+
+boto connections shouldn't be shared across threads,
+so each thread keeps its own; since work is run on
+thread pools, their threads' connections are reused
+across tasks.
+
+Each connection is wrapped in a `cloud.api.Client`,
+which rate limits, retries and accounts for its calls.
 """
 
-from boto.ec2 import connect_to_region as ec2_connect_to_region
-from boto.cloudformation import connect_to_region as cf_connect_to_region
+import threading, importlib
+
+from cloud import config, api
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The modules which connect to each service. These are
+# imported when first needed, since they're slow to import.
+CONNECTORS = {
+    'ec2': 'boto.ec2',
+    'cloudformation': 'boto.cloudformation',
+    's3': 'boto.s3',
+    'autoscale': 'boto.ec2.autoscale',
+    'elb': 'boto.ec2.elb',
+    'rds': 'boto.rds'
+}
+
+_local = threading.local()
+
+# How many connections were created and reused,
+# keyed by `(service, region)`.
+_counts = {}
+_counts_lock = threading.Lock()
+
+def connection(service, region=None):
+    """
+    Gets this thread's connection to a
+    service in a region, creating it if need be.
+    """
+    region = region or config.REGION
+    key = (service, region)
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(key)
+    if conn is None:
+        conn = importlib.import_module(CONNECTORS[service]).connect_to_region(region)
+        if conn is None:
+            raise ValueError('Couldn\'t connect to {0} in {1}; is it a valid region?'.format(service, region))
+        conn = api.Client(conn, service)
+        connections[key] = conn
+        count(key, 'created')
+    else:
+        count(key, 'reused')
+    return conn
+
+def count(key, event):
+    with _counts_lock:
+        counts = _counts.setdefault(key, {'created': 0, 'reused': 0})
+        counts[event] += 1
+
+def stats():
+    """
+    Gets how many connections were created and
+    reused, as a dict keyed by `(service, region)`.
+    """
+    with _counts_lock:
+        return dict((key, dict(counts)) for key, counts in _counts.items())
+
+def log_stats():
+    """
+    Logs how many connections were created and reused.
+    """
+    rows = ['{0:<16} {1:<16} {2:>8} {3:>8}'.format('service', 'region', 'created', 'reused')]
+    for (service, region), counts in sorted(stats().items()):
+        rows.append('{0:<16} {1:<16} {2:>8} {3:>8}'.format(service, region, counts['created'], counts['reused']))
+    if len(rows) > 1:
+        logger.info('Connections:\n{0}'.format('\n'.join(rows)))
+
+def reset():
+    """
+    Drops this thread's connections, e.g.
+    if one has gotten into a bad state.
+    """
+    _local.connections = {}
+
+def ec2(region=None):
+    """
+    Gets an EC2 connection
+    (to the configured region by default).
+    """
+    return connection('ec2', region)
 
-from cloud import config
-REGION = config.REGION
+def cf(region=None):
+    """
+    Gets a CloudFormation connection.
+    """
+    return connection('cloudformation', region)
+
+def s3(region=None):
+    """
+    Gets an S3 connection.
+    """
+    return connection('s3', region)
+
+def autoscale(region=None):
+    """
+    Gets an AutoScaling connection.
+    """
+    return connection('autoscale', region)
 
-def ec2():
+def elb(region=None):
     """
-    Creates an EC2 connection.
+    Gets an Elastic Load Balancing connection.
     """
-    return ec2_connect_to_region(REGION)
+    return connection('elb', region)
 
-def cf():
+def rds(region=None):
     """
-    Creates a CloudFormation connection.
+    Gets an RDS connection.
     """
-    return cf_connect_to_region(REGION)
+    return connection('rds', region)
@@ -6,9 +6,32 @@ Logger!
 """
 
 import logging
+import threading
 from os import path
 
-log_path = path.join(path.dirname(__file__), 'logs/log.log')
+logs_path = path.join(path.dirname(__file__), 'logs')
+log_path = path.join(logs_path, 'log.log')
+
+# Per-thread logging context, e.g. the
+# environment a thread is operating on.
+context = threading.local()
+
+class EnvFilter(logging.Filter):
+    """
+    Tags records with the environment of the thread
+    which logged them. If an `env` is given, only
+    that environment's records are passed.
+    """
+    def __init__(self, env=None):
+        logging.Filter.__init__(self)
+        self.env = env
+
+    def filter(self, record):
+        record.env = getattr(context, 'env', None)
+        record.env_prefix = '[{0}] '.format(record.env) if record.env else ''
+        return self.env is None or record.env == self.env
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(env_prefix)s%(message)s')
 
 def logger(name):
     # Create the logger.
@@ -16,16 +39,27 @@ def logger(name):
 
     # Configure the logger.
     logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     # Output to file.
     fh = logging.FileHandler(log_path)
     fh.setFormatter(formatter)
+    fh.addFilter(EnvFilter())
     logger.addHandler(fh)
 
     # Output to console.
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
+    ch.addFilter(EnvFilter())
     logger.addHandler(ch)
 
     return logger
+
+def env_handler(env):
+    """
+    Creates a handler which logs just
+    one environment's records to its own file.
+    """
+    fh = logging.FileHandler(path.join(logs_path, '{0}.log'.format(env)))
+    fh.setFormatter(formatter)
+    fh.addFilter(EnvFilter(env))
+    return fh
@@ -1,9 +1,11 @@
-import smtplib
-from email.mime.text import MIMEText
-
 from cloud import config
 
 def notify(message):
+    # Imported here since they're only needed
+    # once something is done, and are slow to import.
+    import smtplib
+    from email.mime.text import MIMEText
+
     user        = config.ERROR_EMAIL_USER
     password    = config.ERROR_EMAIL_PASSWORD
     admins      = config.ERROR_ADMINS
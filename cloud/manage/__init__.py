@@ -5,4 +5,4 @@ Manage
 Manage various aspects of a cloud.
 """
 
-import images, formations, provision
+import images, formations, plan, provision, waiter, deploys, rolling
@@ -0,0 +1,151 @@
+"""
+Deploys
+==============
+
+Tracks what each role was last deployed with.
+
+After a role is deployed successfully, a fingerprint
+of its inputs is recorded for the environment: the
+app's git commit, the role's playbook and roles
+(tasks, templates, files, ...), the group vars,
+the instances it was deployed to, and the hosts
+it's configured to talk to (the instances of the
+roles it depends on, and the database), so that
+it's deployed again if any of them is replaced.
+
+If the fingerprint is unchanged on the next
+deploy, there is nothing new to deploy.
+"""
+
+import os, json, hashlib, threading, subprocess
+
+from cloud import connect, config, name
+from cloud.manage import formations
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEPLOYS_DIR = 'playbooks/.cache/deploys'
+GROUP_VARS = 'playbooks/group_vars/all.yml'
+
+# Held while recording fingerprints, since
+# roles are deployed concurrently.
+_lock = threading.Lock()
+
+def fingerprint(app, env, role, git_sha, dependencies=[], database=False):
+    """
+    Fingerprints what goes into deploying a role,
+    which depends on the `dependencies` roles' hosts
+    (and the database's, if `database` is set).
+
+    Returns None if the app's git commit is unknown,
+    in which case the role should always be deployed.
+    """
+    if git_sha is None:
+        return None
+
+    h = hashlib.sha1()
+    h.update('git_sha={0}\n'.format(git_sha).encode('utf-8'))
+    for path in sources(role):
+        content = open(path, 'rb').read()
+        h.update('{0}:{1}\n'.format(path, len(content)).encode('utf-8'))
+        h.update(content)
+    for instance_id in hosts(app, env, role):
+        h.update('host={0}\n'.format(instance_id).encode('utf-8'))
+    for dependency in sorted(dependencies):
+        for instance_id in hosts(app, env, dependency):
+            h.update('{0}={1}\n'.format(dependency, instance_id).encode('utf-8'))
+    if database:
+        h.update('database={0}\n'.format(database_host(app, env)).encode('utf-8'))
+
+    return h.hexdigest()[:16]
+
+def sources(role):
+    """
+    The files which go into a role's playbook:
+    the playbook, the roles it uses, and the group vars.
+    """
+    import yaml
+
+    playbook = 'playbooks/{0}.yml'.format(role)
+    roles = set()
+    for play in yaml.load(open(playbook)) or []:
+        for r in play.get('roles', []):
+            roles.add(r['role'] if isinstance(r, dict) else r)
+
+    paths = [playbook, GROUP_VARS]
+    for r in roles:
+        for root, dirs, files in os.walk(os.path.join('playbooks/roles', r)):
+            paths += [os.path.join(root, f) for f in files]
+    return sorted(paths)
+
+def hosts(app, env, role):
+    """
+    The ids of the running instances a role deploys to.
+    """
+    ec2 = connect.ec2()
+    instances = ec2.get_only_instances(filters={
+        'tag:Name': name.instance(app, env, role),
+        'instance-state-name': 'running'
+    })
+    return sorted(instance.id for instance in instances)
+
+def database_host(app, env):
+    """
+    The address of an environment's database (None if it has none).
+    """
+    stack = formations.get_stack(name.stack(app, env))
+    if stack is None:
+        return None
+    return formations.get_outputs(stack).get('DBAddress')
+
+def git_sha(repo=None):
+    """
+    Gets the commit the app's git repo is at,
+    i.e. what a deploy would check out.
+    """
+    repo = repo or config.GIT_REPO
+    try:
+        output = subprocess.check_output(['git', 'ls-remote', repo, 'HEAD'])
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning('Couldn\'t get the commit for {0}: {1}'.format(repo, e))
+        return None
+    sha = output.decode('utf-8').split()
+    return sha[0] if sha else None
+
+def deploys_path(env):
+    return os.path.join(DEPLOYS_DIR, '{0}.json'.format(env))
+
+def get_fingerprints(env):
+    """
+    Gets the fingerprints each role in an
+    environment was last deployed with.
+    """
+    try:
+        with open(deploys_path(env), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def record(env, role, fingerprint):
+    """
+    Records the fingerprint a role was
+    successfully deployed with.
+    """
+    if fingerprint is None:
+        return
+
+    with _lock:
+        if not os.path.exists(DEPLOYS_DIR):
+            os.makedirs(DEPLOYS_DIR)
+
+        fingerprints = get_fingerprints(env)
+        fingerprints[role] = fingerprint
+
+        # Write to a temporary file first so an
+        # interrupted write doesn't corrupt the record.
+        path = deploys_path(env)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(fingerprints, f, sort_keys=True, indent=2)
+        os.rename(tmp_path, path)
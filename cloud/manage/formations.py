@@ -5,8 +5,12 @@ Formation
 Manages CloudFormation stacks.
 """
 
-import time, json
-from cloud import connect
+import os, time, json, hashlib, threading
+from boto.exception import BotoServerError
+
+from cloud import connect, config, api
+from cloud import name as naming
+from cloud.manage.waiter import StackWaiter, stack_missing
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,31 +19,51 @@ class FormationError(Exception):
     def __init__(self, message):
         self.message = message
 
-def wait_until_ready(name):
-    status = get_stack(name).stack_status
+READY_PENDING = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']
+TERMINATED_PENDING = ['DELETE_IN_PROGRESS']
+ROLLED_BACK_PENDING = ['ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS']
+
+# How long (in seconds) a looked-up stack is reused
+# before it is described again.
+STACK_CACHE_TTL = 15
+
+TEMPLATE_DIR = 'formations'
+
+# Merged templates are cached here by content hash.
+# Bump the version when merging or serialization changes.
+TEMPLATE_CACHE_DIR = os.path.join(TEMPLATE_DIR, '.cache')
+TEMPLATE_CACHE_VERSION = 2
 
-    while status in ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS']:
-        time.sleep(10)
-        status = get_stack(name).stack_status
+# Registry of recently looked-up stacks,
+# keyed by name: (fetched_at, stack).
+_stacks = {}
+_stacks_lock = threading.Lock()
+
+def wait_until_ready(name):
+    try:
+        status = StackWaiter(name).wait(READY_PENDING)
+    finally:
+        invalidate(name)
 
     if status not in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
         raise FormationError('Formation creation failed, status was {0}'.format(status))
 
 def wait_until_terminated(name):
-    stack = get_stack(name)
+    try:
+        status = StackWaiter(name).wait(TERMINATED_PENDING)
+    finally:
+        invalidate(name)
 
-    while stack is not None:
-        time.sleep(10)
-        stack = get_stack(name)
+    if status not in [None, 'DELETE_COMPLETE']:
+        raise FormationError('Formation deletion failed, status was {0}'.format(status))
 
 def wait_until_rolled_back(name):
-    status = get_stack(name).stack_status
-
-    while status == 'ROLLBACK_IN_PROGRESS':
-        time.sleep(10)
-        status = get_stack(name).stack_status
+    try:
+        StackWaiter(name).wait(ROLLED_BACK_PENDING)
+    finally:
+        invalidate(name)
 
-def get_stack(name):
+def get_stack(name, fresh=False):
     """
     Get a stack by name.
 
@@ -49,40 +73,145 @@ def get_stack(name):
     each stack (only `stack.stack_name` and
     `stack.stack_status`)
 
-    Stack names are unique per AWS account,
-    so we only expect to get one.
+    Only the named stack is described, and the
+    result is reused for `STACK_CACHE_TTL` seconds
+    (unless `fresh` is set). Missing stacks are
+    remembered too.
+    """
+    now = time.time()
+    if not fresh:
+        with _stacks_lock:
+            cached = _stacks.get(name)
+        if cached is not None and now - cached[0] < STACK_CACHE_TTL:
+            return cached[1]
+
+    conn = connect.cf()
+    try:
+        stacks = conn.describe_stacks(name)
+    except BotoServerError as e:
+        if not stack_missing(e):
+            raise e
+        stacks = []
+
+    stack = stacks[0] if stacks else None
+    with _stacks_lock:
+        _stacks[name] = (now, stack)
+    return stack
+
+def invalidate(name=None):
+    """
+    Drops a stack (or all stacks, if no name
+    is given) from the registry.
     """
+    with _stacks_lock:
+        if name is None:
+            _stacks.clear()
+        else:
+            _stacks.pop(name, None)
+
+def create_stack(name, template, parameters):
+    conn = connect.cf()
+    try:
+        return conn.create_stack(name, template, parameters=parameters)
+    finally:
+        invalidate(name)
+
+def update_stack(name, template, parameters):
+    conn = connect.cf()
+    try:
+        return conn.update_stack(name, template, parameters=parameters)
+    finally:
+        invalidate(name)
+
+def delete_stack(name):
     conn = connect.cf()
-    stacks = [stack for stack in conn.describe_stacks() if stack.stack_name == name]
-    if len(stacks) == 0:
-        return None
-    return stacks[0]
+    try:
+        return conn.delete_stack(name)
+    finally:
+        invalidate(name)
+
+def get_outputs(stack, keys=None):
+    """
+    Gets a stack's outputs as a dict of key to value.
+
+    If `keys` are specified, a list of just
+    those values is returned, in the same order
+    (missing outputs are None).
+    """
+    outputs = {output.key: output.value for output in stack.outputs}
+    if keys is None:
+        return outputs
+    return [outputs.get(key) for key in keys]
 
 def get_output(stack, key):
     """
     Gets an output value from a stack
     for the specified key.
     """
-    for output in stack.outputs:
-        if output.key == key:
-            return output.value
-    return None
+    return get_outputs(stack).get(key)
 
-def build_template(names):
+def build_template(names, nested=False):
     """
     Builds the cloud's template by combining
     individual templates into one Voltron template.
+
+    If `nested` is set, each template with resources
+    instead becomes its own child stack of the
+    Voltron template (see `nest_templates`).
+
+    Built templates are cached on disk, keyed by a hash
+    of the template names and their contents, so unchanged
+    templates are only parsed, merged and checked once. A
+    cached nested template is only used if its child
+    templates are all still in S3.
     """
+    sources = [open(template_path(name), 'rb').read() for name in names]
+    extra = ['nested', formations_bucket()] if nested else []
+    key = template_key(names, sources, extra)
+    cache_path = os.path.join(TEMPLATE_CACHE_DIR, '{0}.json'.format(key))
+
+    if os.path.exists(cache_path):
+        template = open(cache_path, 'rb').read()
+
+        # Child templates may have gone from S3 since (e.g. if the
+        # bucket was emptied), in which case they're uploaded again.
+        if not nested or templates_uploaded(template):
+            logger.info('Using cached template ({0}).'.format(key[:12]))
+            return template
+        logger.info('Nested templates are missing from S3, rebuilding the template...')
+
+    if nested:
+        template = serialize_template(nest_templates(names, sources))
+    else:
+        template = serialize_template(merge_templates(names, sources))
 
+    # Write to a temporary file first, so
+    # a partially-written template is never cached.
+    if not os.path.exists(TEMPLATE_CACHE_DIR):
+        os.makedirs(TEMPLATE_CACHE_DIR)
+    tmp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(template)
+    os.rename(tmp_path, cache_path)
+
+    return template
+
+def load_templates(names, sources):
+    templates = []
+    for name, source in zip(names, sources):
+        try:
+            templates.append(json.loads(source.decode('utf-8')))
+        except ValueError as e:
+            logger.error('Error with template: {0}'.format(name))
+            raise e
+    return templates
+
+def merge_templates(names, sources):
     voltron = {}
     keys = ['Parameters', 'Resources', 'Outputs', 'Mappings']
 
     # Load all the templates.
-    try:
-        templates = [json.load(open('formations/{0}.json'.format(name))) for name in names]
-    except ValueError as e:
-        logger.error('Error with template: {0}'.format(name))
-        raise e
+    templates = load_templates(names, sources)
 
     for key in keys:
         merged = {}
@@ -90,13 +219,220 @@ def build_template(names):
         for template in templates:
             if key in template:
                 expected_items += len(template[key])
-                if not merged:
-                    merged = template[key].copy()
-                else:
-                    merged.update(template[key])
+                merged.update(template[key])
         voltron[key] = merged
         if len(voltron[key]) != expected_items:
             raise Exception('Merging didn\'t preserve all items for key {0}. There may be conflicting names, exiting!'.format(key))
 
     voltron['AWSTemplateFormatVersion'] = '2010-09-09'
-    return json.dumps(voltron).encode('utf-8')
+    return voltron
+
+def nest_templates(names, sources):
+    """
+    Builds a Voltron template where each template with
+    resources is a nested (child) stack, so that tiers
+    can be updated independently.
+
+    All parameters are declared on the parent and passed
+    down to the children which use them. Where a template
+    refers to another template's resource, the owning child
+    exports it as an output and the referring child takes it as
+    a parameter, which also orders their creation; children
+    without such dependencies are created concurrently.
+    The children's outputs are passed up as the parent's outputs.
+
+    Only children whose template or parameters changed are
+    updated, since the child templates are uploaded to S3
+    under content-addressed keys.
+    """
+    templates = load_templates(names, sources)
+    parent = merge_templates(names, sources)
+    parameters = parent['Parameters']
+
+    children = [(name, template) for name, template in zip(names, templates) if template.get('Resources')]
+    owners = {}
+    for name, template in children:
+        for resource in template['Resources']:
+            owners[resource] = name
+
+    # Find cross-template references and
+    # export them from their owners.
+    imports = {}
+    exports = set()
+    for name, template in children:
+        imports[name] = {}
+        for ref in find_refs(template):
+            resource = ref[0]
+            owner = owners.get(resource)
+            if resource.startswith('AWS::') or resource in template['Resources'] or owner is None:
+                continue
+            output = ''.join(ref).replace('.', '')
+            imports[name][output] = (owner, ref)
+            exports.add(output)
+            owner_template = dict(children)[owner]
+            owner_template.setdefault('Outputs', {})[output] = {
+                'Description': 'Exported for the {0} stack.'.format(name),
+                'Value': ref_value(ref)
+            }
+
+    parent['Resources'] = {}
+    parent['Outputs'] = {}
+    del parent['Mappings']
+    for name, template in children:
+        child_params = {}
+        template_params = template.setdefault('Parameters', {})
+        for ref in find_refs(template):
+            key = ref[0]
+            if key in parameters:
+                template_params[key] = parameters[key]
+                child_params[key] = {'Ref': key}
+
+        for output, (owner, ref) in imports[name].items():
+            template_params[output] = {
+                'Description': 'Imported from the {0} stack.'.format(owner),
+                'Type': 'String'
+            }
+            child_params[output] = {'Fn::GetAtt': [child_stack_id(owner), 'Outputs.{0}'.format(output)]}
+            template['Resources'] = replace_ref(template['Resources'], ref, output)
+            template['Outputs'] = replace_ref(template.get('Outputs', {}), ref, output)
+
+        template['AWSTemplateFormatVersion'] = '2010-09-09'
+        parent['Resources'][child_stack_id(name)] = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': upload_template(serialize_template(template)),
+                'Parameters': child_params
+            }
+        }
+
+    for name, template in zip(names, templates):
+        for output in template.get('Outputs', {}):
+            if output not in exports:
+                parent['Outputs'][output] = {
+                    'Value': {'Fn::GetAtt': [child_stack_id(name), 'Outputs.{0}'.format(output)]}
+                }
+
+    return parent
+
+def is_nested(template):
+    """
+    Whether a (parsed) template is
+    built from nested stacks.
+    """
+    resources = template.get('Resources', {}).values()
+    return any(resource.get('Type') == 'AWS::CloudFormation::Stack' for resource in resources)
+
+def child_stack_id(name):
+    return '{0}Stack'.format(name.title().replace('_', ''))
+
+def find_refs(obj):
+    """
+    Finds the `Ref`s and `Fn::GetAtt`s in (part of) a template,
+    as tuples of `(name,)` and `(name, attribute)` respectively.
+    """
+    refs = set()
+    if isinstance(obj, dict):
+        if len(obj) == 1 and 'Ref' in obj:
+            refs.add((obj['Ref'],))
+        elif len(obj) == 1 and 'Fn::GetAtt' in obj:
+            refs.add(tuple(obj['Fn::GetAtt']))
+        else:
+            for value in obj.values():
+                refs |= find_refs(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            refs |= find_refs(value)
+    return refs
+
+def ref_value(ref):
+    if len(ref) == 1:
+        return {'Ref': ref[0]}
+    return {'Fn::GetAtt': list(ref)}
+
+def replace_ref(obj, ref, parameter):
+    """
+    Replaces a `Ref` or `Fn::GetAtt` with a `Ref` to a parameter.
+    """
+    if obj == ref_value(ref):
+        return {'Ref': parameter}
+    if isinstance(obj, dict):
+        return {k: replace_ref(v, ref, parameter) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [replace_ref(v, ref, parameter) for v in obj]
+    return obj
+
+def formations_bucket():
+    """
+    The S3 bucket which nested stack templates are uploaded to.
+    Set `formations_bucket` in the config to override it.
+    """
+    return getattr(config, 'FORMATIONS_BUCKET', naming.formations_bucket(config.APP_NAME))
+
+def upload_template(template):
+    """
+    Uploads a (serialized) child template to S3, keyed by
+    its hash, and returns its URL. Templates which are already
+    uploaded are left as they are.
+    """
+    conn = connect.s3()
+    bucket_name = formations_bucket()
+    bucket = conn.lookup(bucket_name)
+    if bucket is None:
+        logger.info('Creating bucket {0} for nested templates...'.format(bucket_name))
+        location = '' if config.REGION == 'us-east-1' else config.REGION
+        bucket = conn.create_bucket(bucket_name, location=location)
+
+    key_name = 'formations/{0}.json'.format(hashlib.sha1(template).hexdigest())
+    # Buckets and keys call S3 through their own (unwrapped)
+    # connection, so these go through `cloud.api` explicitly.
+    key = api.call('s3', 'get_key', bucket.get_key, key_name)
+    if key is None:
+        key = bucket.new_key(key_name)
+        api.call('s3', 'set_contents_from_string', key.set_contents_from_string, template)
+    return key.generate_url(0, query_auth=False)
+
+def templates_uploaded(template):
+    """
+    Whether the child templates a (serialized) nested template
+    refers to are all still in S3, checking each one's key.
+    """
+    urls = [resource['Properties']['TemplateURL'] for resource in json.loads(template.decode('utf-8'))['Resources'].values()
+            if resource.get('Type') == 'AWS::CloudFormation::Stack']
+    if not urls:
+        return True
+
+    bucket = connect.s3().lookup(formations_bucket())
+    if bucket is None:
+        return False
+    for url in urls:
+        key_name = 'formations/{0}'.format(url.rsplit('/', 1)[-1])
+        if api.call('s3', 'get_key', bucket.get_key, key_name) is None:
+            return False
+    return True
+
+def serialize_template(template):
+    """
+    Serializes a template deterministically (sorted keys)
+    so that the same template always gives the same bytes,
+    and compactly, since CloudFormation limits how big
+    a template body may be.
+    """
+    return json.dumps(template, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def template_path(name):
+    return os.path.join(TEMPLATE_DIR, '{0}.json'.format(name))
+
+def template_key(names, sources, extra=[]):
+    """
+    Hashes the template names (order matters for merging)
+    and their contents, along with anything `extra`
+    the built template depends on.
+    """
+    h = hashlib.sha1()
+    h.update('{0}\n'.format(TEMPLATE_CACHE_VERSION).encode('utf-8'))
+    for part in extra:
+        h.update('{0}\n'.format(part).encode('utf-8'))
+    for name, source in zip(names, sources):
+        h.update('{0}:{1}\n'.format(name, len(source)).encode('utf-8'))
+        h.update(source)
+    return h.hexdigest()
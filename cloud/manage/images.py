@@ -8,49 +8,134 @@ the creation of images from them.
 
 from boto.exception import EC2ResponseError
 
-from cloud import connect, command
+from cloud import connect, command, config, probe
 from cloud.manage import formations, provision
+from cloud.manage.waiter import backoff
 
 from subprocess import CalledProcessError
+from datetime import datetime
 from time import sleep
+import os, re, hashlib
 
 import logging
 logger = logging.getLogger(__name__)
 
-def get_image(name):
+# What goes into an image, for fingerprinting.
+IMAGE_SOURCES = ['playbooks/image.yml', 'playbooks/roles/common']
+
+# How many fingerprinted images to keep around (e.g. for rollbacks).
+DEFAULT_IMAGE_RETENTION = 3
+
+class ImageFailed(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+def fingerprint(base_ami_id):
+    """
+    Fingerprints what goes into an image: the `image`
+    playbook, the `common` role, the base AMI, and the
+    config values they refer to.
+
+    If the fingerprint is unchanged, so is the image.
     """
-    Tries to get an existing image.
+    paths = []
+    for source in IMAGE_SOURCES:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                paths += [os.path.join(root, f) for f in files]
+        else:
+            paths.append(source)
+
+    h = hashlib.sha1()
+    h.update('base_ami={0}\n'.format(base_ami_id).encode('utf-8'))
+    used_vars = set()
+    for path in sorted(paths):
+        content = open(path, 'rb').read()
+        h.update('{0}:{1}\n'.format(path, len(content)).encode('utf-8'))
+        h.update(content)
+        used_vars |= set(var.decode('utf-8') for var in re.findall(br'{{\s*(\w+)', content))
+
+    for var in sorted(used_vars):
+        h.update('{0}={1}\n'.format(var, getattr(config, var.upper(), None)).encode('utf-8'))
+
+    return h.hexdigest()[:16]
+
+def get_image(name, fingerprint=None, region=None):
+    """
+    Tries to get an existing, available image.
+
+    If a fingerprint is given, only an image
+    baked with that fingerprint will do.
+
+    If the image is still pending (e.g. another run
+    is baking or copying it), it is waited on. Images
+    which failed are deregistered, so they're made again.
     """
     logger.info('Looking for an existing image...')
-    ec2 = connect.ec2()
-    images = ec2.get_all_images(filters={'name': name})
-    if images:
-        ami_id = images[0].id
+    ec2 = connect.ec2(region)
+    if fingerprint is None:
+        images = ec2.get_all_images(filters={'name': name})
+    else:
+        images = ec2.get_all_images(filters={'tag:Image': name, 'tag:Fingerprint': fingerprint})
+
+    failed = [image for image in images if image.state not in ['available', 'pending']]
+    if failed:
+        logger.warning('Deregistering {0} failed image(s)...'.format(len(failed)))
+        deregister_images(failed, region)
+
+    available = [image for image in images if image.state == 'available']
+    pending = [image for image in images if image.state == 'pending']
+    if not available and pending:
+        image = pending[0]
+        logger.info('Existing image {0} is pending, waiting on it...'.format(image.id))
+        try:
+            wait_until_images_ready({region or config.REGION: image.id})
+        except ImageFailed as e:
+            logger.warning('{0} Deregistering it...'.format(e))
+            deregister_images([image], region)
+            return None
+        available = [image]
+
+    if available:
+        ami_id = available[0].id
 
         logger.info('Existing image found. ({0})'.format(ami_id))
         return ami_id
     return None
 
 
-def create_image(name):
+def create_image(name, fingerprint=None, instance=None):
     """
     Create an image from an instance.
+
+    If a fingerprint is given, it is included in the
+    AMI's name, and the AMI is tagged with it so
+    it can be found (and evicted) later.
+
+    If an `instance` is given (e.g. from the warm pool),
+    the image is created from it and it is left as is.
+    Otherwise the image instance is used and then deleted.
     """
     ec2 = connect.ec2()
+    ami_name = name if fingerprint is None else '{0}-{1}'.format(name, fingerprint)
 
     # Clean up any existing images.
     # Things usually mess up if there
     # is conflicting/existing stuff.
-    delete_image(name)
+    deregister_images(ec2.get_all_images(filters={'name': ami_name}))
 
     # Try to use an existing base if specified.
     logger.info('Looking for an existing base instance...')
-    base_instance = None
-    base_instances = ec2.get_all_instances(filters={'tag-key': 'Name', 'tag-value': name})
+    base_instance = instance
+    base_instances = [] if instance is not None else ec2.get_all_instances(filters={'tag-key': 'Name', 'tag-value': name})
     for reservation in base_instances:
         if reservation.instances:
             base_instance = reservation.instances[0]
-            if base_instance.update() != 'ready':
+            # Just described, so its state is current.
+            if base_instance.state != 'ready':
                 continue
             else:
                 logger.info('Existing base instance found.')
@@ -62,25 +147,30 @@ def create_image(name):
     try:
         # Create the AMI and get its ID.
         logger.info('Creating image...')
-        ami_id = base_instance.create_image(name, description='Base image {0}'.format(name))
+        ami_id = ec2.create_image(base_instance.id, ami_name, description='Base image {0}'.format(ami_name))
+
+        # Tag it straight away, so it can be found
+        # (and evicted) even if we don't see it through.
+        if fingerprint is not None:
+            tag_image(ami_id, name, fingerprint)
 
         # Wait until instance is ready.
-        image = ec2.get_all_images([ami_id])[0]
-        wait_until_ready(image)
+        wait_until_ready(ami_id)
         logger.info('Created image with id {0}'.format(ami_id))
 
         # Clean up the image infrastructure.
-        delete_image_instance(name)
+        if instance is None:
+            delete_image_instance(name)
 
         logger.info('AMI creation complete. ({0})'.format(ami_id))
 
         return ami_id
 
-    except EC2ResponseError as e:
+    except (EC2ResponseError, ImageFailed) as e:
         logger.error('Error creating the image, undoing...')
 
         # Try to undo all the changes.
-        delete_image(name)
+        deregister_images(ec2.get_all_images(filters={'name': ami_name}))
 
         # Re-raise the error.
         raise e
@@ -88,10 +178,18 @@ def create_image(name):
 
 def delete_image(name):
     """
-    Deregisters the AMI and deletes its snapshot.
+    Deregisters the AMI (and any fingerprinted
+    versions of it) and deletes its snapshot.
     """
     ec2 = connect.ec2()
     images = ec2.get_all_images(filters={'name': name})
+    images += ec2.get_all_images(filters={'tag:Image': name})
+    images += untagged_images(name)
+    deregister_images(dict((image.id, image) for image in images).values())
+
+
+def deregister_images(images, region=None):
+    ec2 = connect.ec2(region)
     for image in images:
         image_id = image.id
         logger.info('Deleting image with id {0}'.format(image_id))
@@ -107,9 +205,163 @@ def delete_image(name):
             logger.warning('Could not deregister the image. It may already be deregistered.')
 
 
-def create_image_instance(name, base_ami_id, key_name):
-    conn = connect.cf()
+def tag_image(ami_id, name, fingerprint, region=None):
+    """
+    Tags a fingerprinted image, so it can be found (and evicted).
+    """
+    ec2 = connect.ec2(region)
+    ec2.create_tags([ami_id], {
+        'Image': name,
+        'Fingerprint': fingerprint,
+        'LastUsed': timestamp()
+    })
+
+
+def untagged_images(name, region=None):
+    """
+    Gets fingerprinted images which were never tagged
+    (e.g. if baking or copying them was interrupted).
+    """
+    ec2 = connect.ec2(region)
+    images = ec2.get_all_images(filters={'name': '{0}-*'.format(name)})
+    return [image for image in images if 'Image' not in image.tags]
+
+
+def touch_image(ami_id, region=None):
+    """
+    Marks an image as just used.
+    """
+    ec2 = connect.ec2(region)
+    ec2.create_tags([ami_id], {'LastUsed': timestamp()})
+
+
+def evict_images(name, keep=DEFAULT_IMAGE_RETENTION, region=None):
+    """
+    Deregisters all but the `keep` most recently
+    used fingerprinted images, and any which
+    were never tagged.
+
+    Images which the app's stacks still use (see
+    `images_in_use`) are kept regardless, since
+    replacement instances are launched from them.
+    """
+    ec2 = connect.ec2(region)
+    images = ec2.get_all_images(filters={'tag:Image': name})
+    images.sort(key=lambda image: image.tags.get('LastUsed', ''), reverse=True)
+    evicted = images[keep:] + untagged_images(name, region)
+    if evicted:
+        in_use = images_in_use(region)
+        for image in evicted:
+            if image.id in in_use:
+                logger.info('Keeping image {0}, it is still in use.'.format(image.id))
+        evicted = [image for image in evicted if image.id not in in_use]
+    if evicted:
+        logger.info('Evicting {0} least recently used image(s)...'.format(len(evicted)))
+        deregister_images(evicted, region)
+
+
+# Stack statuses in which a stack (and
+# its launch configurations) still exists.
+ACTIVE_STACK_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_COMPLETE', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS',
+    'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE'
+]
+
+def images_in_use(region=None):
+    """
+    Gets the ids of images which the app's stacks
+    (environments, their nested stacks and the image
+    pool) refer to, by their parameters or their
+    launch configurations.
+
+    Only the app's stacks are described; the rest
+    of the account's are only listed (by name).
+    """
+    in_use = set()
+    prefix = '{0}-'.format(config.APP_NAME)
+
+    conn = connect.cf(region)
+    stack_names = []
+    next_token = None
+    while True:
+        summaries = conn.list_stacks(stack_status_filters=ACTIVE_STACK_STATUSES, next_token=next_token)
+        stack_names += [summary.stack_name for summary in summaries if summary.stack_name.startswith(prefix)]
+        next_token = getattr(summaries, 'next_token', None)
+        if not next_token:
+            break
+
+    launch_configs = []
+    for stack_name in stack_names:
+        for stack in conn.describe_stacks(stack_name):
+            in_use |= set(param.value for param in stack.parameters if (param.value or '').startswith('ami-'))
+        launch_configs += [resource.physical_resource_id for resource in conn.describe_stack_resources(stack_name)
+                           if resource.resource_type == 'AWS::AutoScaling::LaunchConfiguration' and resource.physical_resource_id]
+
+    conn = connect.autoscale(region)
+    for i in range(0, len(launch_configs), 50):
+        configs = conn.get_all_launch_configurations(names=launch_configs[i:i + 50])
+        in_use |= set(launch_config.image_id for launch_config in configs)
+
+    return in_use
+
+
+def replicate_image(name, ami_id, fingerprint, regions):
+    """
+    Copies a fingerprinted image from the configured
+    region to each of `regions`, reusing any copies
+    which already exist there.
+
+    The copies are all started at once and
+    then waited on together.
+
+    Returns a dict of region to AMI id
+    (including the configured region).
+    """
+    amis = {config.REGION: ami_id}
+    pending = {}
+    ami_name = '{0}-{1}'.format(name, fingerprint)
 
+    for region in regions:
+        if region in amis:
+            continue
+
+        # An existing copy may still be pending (if
+        # another run started it), so it's waited on too.
+        existing = get_image(name, fingerprint, region=region)
+        if existing is not None:
+            touch_image(existing, region)
+            pending[region] = existing
+            continue
+
+        # A copy left untagged by an interrupted run.
+        existing = get_image(ami_name, region=region)
+        if existing is not None:
+            tag_image(existing, name, fingerprint, region)
+            pending[region] = existing
+            continue
+
+        logger.info('Copying image {0} to {1}...'.format(ami_id, region))
+        ec2 = connect.ec2(region)
+        copy = ec2.copy_image(config.REGION, ami_id, name=ami_name, description='Base image {0}'.format(ami_name))
+
+        # Tag it straight away, so it can be found
+        # (and evicted) even if we don't see it through.
+        tag_image(copy.image_id, name, fingerprint, region)
+        pending[region] = copy.image_id
+
+    if pending:
+        wait_until_images_ready(pending)
+        amis.update(pending)
+
+    return amis
+
+def timestamp():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def create_image_instance(name, base_ami_id, key_name):
     if formations.get_stack(name) is not None:
         logger.info('Image instance already exists.')
         return
@@ -117,10 +369,10 @@ def create_image_instance(name, base_ami_id, key_name):
     image_template = open('formations/image.json', 'rb').read()
 
     logger.info('Creating image instance ({0})...'.format(name))
-    conn.create_stack(
+    formations.create_stack(
             name,
             image_template,
-            parameters=[
+            [
                 ('ImageId', base_ami_id),
                 ('InstanceName', name),
                 ('KeyName', key_name)
@@ -139,16 +391,17 @@ def create_image_instance(name, base_ami_id, key_name):
         raise Exception('Image instance creation failed.')
 
     stack = formations.get_stack(name)
-    instance_ip = formations.get_output(stack, 'PublicIP')
-    instance_host = formations.get_output(stack, 'PublicDNSName')
+    instance_ip, instance_host = formations.get_outputs(stack, ['PublicIP', 'PublicDNSName'])
     logger.info('Instance up at {0} ({1}).'.format(instance_host, instance_ip))
 
     logger.info('Waiting for SSH to become active...')
-    sleep(120)
+    if not probe.wait_for_ssh([instance_ip])[instance_ip]:
+        raise Exception('Image instance did not become reachable over SSH.')
 
     # Need to add the instance to known hosts.
     logger.info('Adding instance to known hosts...')
-    command.add_to_known_hosts([instance_ip, instance_host])
+    if not all(command.add_to_known_hosts([instance_ip, instance_host]).values()):
+        raise Exception('Could not add the image instance to known hosts.')
     logger.info('Image instance successfully created.')
 
 def configure_image_instance(name, app, key_name):
@@ -161,25 +414,192 @@ def configure_image_instance(name, app, key_name):
         raise Exception('Image instance configuring failed.')
 
 def delete_image_instance(name):
-    conn = connect.cf()
-
-    stacks = [stack for stack in conn.describe_stacks() if stack.stack_name == name]
-    if len(stacks) == 0:
+    if formations.get_stack(name) is None:
         logger.info('Image instance is already deleted.')
         return
 
-    conn.delete_stack(name)
+    formations.delete_stack(name)
 
     logger.info('Waiting for image instance to delete...')
     formations.wait_until_terminated(name)
     logger.info('Image instance deleted.')
 
 
-def wait_until_ready(instance):
+def pool_stack_name(name, index):
+    return '{0}-pool-{1}'.format(name, index)
+
+def get_pool(name, states=['stopped']):
+    """
+    Gets the warm pool's instances in the given states.
+
+    Pool instances are image instances (with the same
+    `Name` tag, so the `image` playbook targets them
+    while they are running) in their own stacks.
+    """
+    ec2 = connect.ec2()
+    reservations = ec2.get_all_instances(filters={
+        'tag:aws:cloudformation:stack-name': pool_stack_name(name, '*'),
+        'instance-state-name': states
+    })
+    return [instance for reservation in reservations for instance in reservation.instances]
+
+def refill_pool(name, app, base_ami_id, key_name, size):
+    """
+    Brings the warm pool up to `size` provisioned,
+    stopped image instances.
     """
-    Wait until an instance is ready.
+    members = get_pool(name, ['pending', 'running', 'stopping', 'stopped'])
+    missing = size - len(members)
+    if missing <= 0:
+        logger.info('The image pool is full ({0} instances).'.format(len(members)))
+        return
+
+    logger.info('Adding {0} instance(s) to the image pool...'.format(missing))
+    image_template = open('formations/image.json', 'rb').read()
+    stack_names = []
+    index = 0
+    while len(stack_names) < missing:
+        stack_name = pool_stack_name(name, index)
+        index += 1
+        if formations.get_stack(stack_name) is not None:
+            continue
+        formations.create_stack(
+                stack_name,
+                image_template,
+                [
+                    ('ImageId', base_ami_id),
+                    ('InstanceName', name),
+                    ('KeyName', key_name)
+                ]
+        )
+        stack_names.append(stack_name)
+
+    # The stacks are created concurrently;
+    # waiting on them in turn only waits for the slowest.
+    instance_ids = []
+    hosts = []
+    for stack_name in stack_names:
+        formations.wait_until_ready(stack_name)
+        stack = formations.get_stack(stack_name)
+        instance_id, instance_ip = formations.get_outputs(stack, ['InstanceId', 'PublicIP'])
+        instance_ids.append(instance_id)
+        hosts.append(instance_ip)
+
+    ready = probe.wait_for_ssh(hosts)
+    if not all(ready.values()):
+        raise Exception('Not all pool instances became reachable over SSH.')
+    if not all(command.add_to_known_hosts(hosts).values()):
+        raise Exception('Could not add all pool instances to known hosts.')
+
+    # This provisions all running image instances at once.
+    configure_image_instance(name, app, key_name)
+
+    logger.info('Stopping the new pool instances...')
+    connect.ec2().stop_instances(instance_ids)
+
+def trim_pool(name, base_ami_id, size):
+    """
+    Deletes stopped pool instances which were launched
+    from a different base AMI, and any beyond `size`
+    (keeping the newest).
+    """
+    members = get_pool(name)
+    stale = [instance for instance in members if instance.image_id != base_ami_id]
+    fresh = [instance for instance in members if instance.image_id == base_ami_id]
+    fresh.sort(key=lambda instance: instance.launch_time, reverse=True)
+
+    stack_names = [instance.tags['aws:cloudformation:stack-name'] for instance in stale + fresh[size:]]
+    for stack_name in stack_names:
+        logger.info('Removing {0} from the image pool...'.format(stack_name))
+        formations.delete_stack(stack_name)
+    for stack_name in stack_names:
+        formations.wait_until_terminated(stack_name)
+
+def start_from_pool(name, base_ami_id):
+    """
+    Starts a stopped pool instance launched from
+    the base AMI, if there is one, and waits
+    until it is reachable over SSH.
+
+    Instances launched from another base AMI
+    are left for `trim_pool` to clean up.
+    """
+    members = [instance for instance in get_pool(name) if instance.image_id == base_ami_id]
+    if not members:
+        return None
+
+    ec2 = connect.ec2()
+    instance = members[0]
+    logger.info('Starting pool instance {0}...'.format(instance.id))
+    ec2.start_instances([instance.id])
+
+    delays = backoff()
+    while instance.state != 'running':
+        sleep(next(delays))
+        instance = get_instance(instance.id)
+
+    logger.info('Waiting for SSH to become active...')
+    if not probe.wait_for_ssh([instance.ip_address])[instance.ip_address]:
+        raise Exception('Pool instance did not become reachable over SSH.')
+    if not all(command.add_to_known_hosts([instance.ip_address, instance.public_dns_name]).values()):
+        raise Exception('Could not add the pool instance to known hosts.')
+    return instance
+
+def return_to_pool(instance):
+    logger.info('Returning instance {0} to the image pool...'.format(instance.id))
+    connect.ec2().stop_instances([instance.id])
+
+def get_instance(instance_id, region=None):
+    """
+    Describes an instance (rather than `instance.update()`,
+    so the call goes through `cloud.api` like the rest).
+    """
+    reservations = connect.ec2(region).get_all_instances([instance_id])
+    return reservations[0].instances[0]
+
+def wait_until_images_ready(amis):
+    """
+    Waits until images in several regions are available,
+    given a dict of region to AMI id (or list of AMI ids).
+
+    Each tick makes a single `describe_images`
+    call per region for all of its pending images.
+    """
+    pending = {}
+    for region, ami_ids in amis.items():
+        pending[region] = set(ami_ids if isinstance(ami_ids, (list, tuple, set)) else [ami_ids])
+
+    delays = backoff()
+    next(delays)
+    while pending:
+        progressed = False
+        for region, ami_ids in list(pending.items()):
+            for image in connect.ec2(region).get_all_images(list(ami_ids)):
+                if image.state == 'pending':
+                    continue
+                if image.state != 'available':
+                    raise ImageFailed('Image {0} in {1} failed, its state was {2}.'.format(image.id, region, image.state))
+                logger.info('Image {0} is available in {1}.'.format(image.id, region))
+                ami_ids.discard(image.id)
+                progressed = True
+            if not ami_ids:
+                del pending[region]
+
+        if pending:
+            sleep(delays.send(progressed))
+
+def wait_until_ready(ami_id, region=None):
+    """
+    Wait until an image is ready.
+
+    Raises an `ImageFailed` if it ends
+    up in any state but 'available'.
     """
-    istatus = instance.update()
-    while istatus == 'pending':
-        sleep(10)
-        istatus = instance.update()
+    ec2 = connect.ec2(region)
+    delays = backoff()
+    state = ec2.get_all_images([ami_id])[0].state
+    while state == 'pending':
+        sleep(next(delays))
+        state = ec2.get_all_images([ami_id])[0].state
+    if state != 'available':
+        raise ImageFailed('Image {0} failed, its state was {1}.'.format(ami_id, state))
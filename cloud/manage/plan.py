@@ -0,0 +1,98 @@
+"""
+Plan
+==============
+
+Plans stack updates locally.
+
+The deployed template and parameters are fetched
+once and diffed against what would be sent, so
+we know what an update will change (if anything)
+without round-tripping through CloudFormation.
+"""
+
+import json
+
+from cloud import connect
+
+import logging
+logger = logging.getLogger(__name__)
+
+# What CloudFormation returns in place of NoEcho parameter values.
+MASKED_VALUE = '****'
+
+class Plan(object):
+    """
+    The resource-level changes an update would make.
+    """
+
+    def __init__(self, name, deployed):
+        self.name = name
+        self.deployed = deployed
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.parameters = []
+        self.sections = []
+        self.masked = []
+
+    @property
+    def changed(self):
+        return any([self.added, self.removed, self.modified, self.parameters, self.sections])
+
+    def log(self):
+        if not self.changed:
+            logger.info('Plan for {0}: no infrastructure changes.'.format(self.name))
+        else:
+            logger.info('Plan for {0}:'.format(self.name))
+            for symbol, ids in [('+', self.added), ('-', self.removed), ('~', self.modified)]:
+                for logical_id in ids:
+                    logger.info('  {0} {1}'.format(symbol, logical_id))
+            for key in self.parameters:
+                logger.info('  ~ parameter {0}'.format(key))
+            for section in self.sections:
+                logger.info('  ~ {0}'.format(section))
+
+        if self.masked:
+            logger.info('NoEcho parameters can\'t be compared and were assumed unchanged: {0}'.format(', '.join(self.masked)))
+
+def get_template(name):
+    """
+    Gets the template body a stack was last deployed with.
+    """
+    conn = connect.cf()
+    response = conn.get_template(name)
+    body = response['GetTemplateResponse']['GetTemplateResult']['TemplateBody']
+    return json.loads(body)
+
+def plan(stack, template, parameters):
+    """
+    Diffs a deployed stack against a (serialized) template
+    and a list of `(key, value)` parameters.
+    """
+    deployed = get_template(stack.stack_name)
+    result = Plan(stack.stack_name, deployed)
+    proposed = json.loads(template.decode('utf-8'))
+
+    deployed_resources = deployed.get('Resources', {})
+    proposed_resources = proposed.get('Resources', {})
+    for logical_id in sorted(set(deployed_resources) | set(proposed_resources)):
+        if logical_id not in deployed_resources:
+            result.added.append(logical_id)
+        elif logical_id not in proposed_resources:
+            result.removed.append(logical_id)
+        elif deployed_resources[logical_id] != proposed_resources[logical_id]:
+            result.modified.append(logical_id)
+
+    for section in sorted(set(deployed) | set(proposed)):
+        if section != 'Resources' and deployed.get(section) != proposed.get(section):
+            result.sections.append(section)
+
+    deployed_parameters = {param.key: param.value for param in stack.parameters}
+    for key, value in parameters:
+        deployed_value = deployed_parameters.get(key)
+        if deployed_value == MASKED_VALUE:
+            result.masked.append(key)
+        elif deployed_value != str(value):
+            result.parameters.append(key)
+
+    return result
@@ -3,29 +3,146 @@ Provision
 ==============
 
 Manages provisioning of instances.
+
+Playbooks are run with a generated `ansible.cfg`
+which is tuned for our deploys: SSH pipelining,
+persistent control sockets (so each host's SSH
+connection is set up once rather than per task),
+and forks sized to the inventory.
+
+(Fact caching would help too, but the pinned
+Ansible (1.5) doesn't support it.)
+
+Each run also records how long each of its tasks
+took on each host (see `cloud.timings`).
 """
 
 from cloud.command import cmd
-import yaml
+from cloud.timings import run_path
+import os
+import re
+import json
+import tempfile
+
+# How verbose ansible-playbook is (the number of `-v`s).
+VERBOSITY = 0
+
+CACHE_DIR = 'playbooks/.cache'
+# One config per `forks` value, so concurrent
+# playbooks never rewrite each other's config.
+CONFIG_PATH = os.path.join(CACHE_DIR, 'ansible.forks-{forks}.cfg')
+CALLBACK_PLUGINS_DIR = 'playbooks/callback_plugins'
+
+# Where the EC2 inventory script caches its results (see `ec2.ini`).
+INVENTORY_CACHE_DIR = os.path.expanduser('~/.ansible/tmp')
+
+MIN_FORKS = 5
+MAX_FORKS = 50
 
-def provision(app, playbook, key_name, env=None):
+ANSIBLE_CONFIG = """# Generated by cloud.manage.provision; changes will be overwritten.
+[defaults]
+forks = {forks}
+callback_plugins = {callback_plugins_dir}
+
+[ssh_connection]
+pipelining = True
+ssh_args = -o ControlMaster=auto -o ControlPersist=30m -o ServerAliveInterval=120
+"""
+
+def provision(app, playbook, key_name, env=None, extra_vars={}, prefix=None, verbosity=None, limit=None):
     """
     Calls an Ansible playbook to provision
     remote instances.
 
     This uses the EC2 dynamic inventory script
-    to get all EC2 hosts.
+    to get the EC2 hosts, scoped (by their Name tag) to
+    the environment's hosts, or to the image instances.
+
+    If a `prefix` is given, each line of output is prefixed
+    with it (e.g. when several playbooks run at once).
+
+    If a `limit` (a list of hosts or groups, e.g. instance ids)
+    is given, only those hosts are provisioned.
     """
 
     vars = ['app_name={0}'.format(app)]
     if env is not None:
         vars.append('env_name={0}'.format(env))
+    for key, value in sorted(extra_vars.items()):
+        vars.append('{0}={1}'.format(key, value))
 
     command = ['ansible-playbook',
         '-i', 'playbooks/hosts/ec2.py',                 # Use the EC2 dynamic inventory script.
         'playbooks/{0}.yml'.format(playbook),           # Load the playbook.
         '--private-key=keys/{0}.pem'.format(key_name),  # Load the proper key.
-        '-e', '""{vars}""'.format(vars=' '.join(vars)), # Set the necessary variables. Double quotes are necessary!
-        '-vvvv']                                       # Verbose output for debugging.
+        '-e', '""{vars}""'.format(vars=' '.join(vars))] # Set the necessary variables. Double quotes are necessary!
+
+    if limit:
+        command += ['--limit', ':'.join(limit)]
+
+    verbosity = VERBOSITY if verbosity is None else verbosity
+    if verbosity:
+        command.append('-' + 'v' * verbosity)
 
-    cmd(command)
+    # The inventory only needs the hosts the playbook can target,
+    # i.e. the environment's (or the image instances).
+    if env is not None:
+        group = 'tag_Env_{0}'.format(env)
+        name_prefix = '{0}-{1}-'.format(app, env)
+    else:
+        group = 'tag_Name_{0}-image'.format(app)
+        name_prefix = '{0}-image'.format(app)
+
+    environ = dict(os.environ,
+        EC2_NAME_PREFIX=name_prefix,
+        ANSIBLE_CONFIG=write_config(inventory_size(group, name_prefix)),
+        CLOUD_TIMINGS_PATH=run_path(playbook, env),
+        CLOUD_TIMINGS_PLAYBOOK=playbook,
+        CLOUD_TIMINGS_ENV=env or '')
+
+    cmd(command, prefix=prefix, env=environ)
+
+def write_config(hosts):
+    """
+    Writes a managed `ansible.cfg` with `forks`
+    sized to the hosts, returning its path.
+    """
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    forks = max(MIN_FORKS, min(hosts, MAX_FORKS))
+    config = ANSIBLE_CONFIG.format(
+        forks=forks,
+        callback_plugins_dir=os.path.abspath(CALLBACK_PLUGINS_DIR)
+    )
+
+    # Write to a (uniquely named) temporary file first,
+    # since concurrent playbooks may be reading it.
+    path = CONFIG_PATH.format(forks=forks)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(config)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+    return os.path.abspath(path)
+
+def inventory_size(group, name_prefix=None):
+    """
+    Estimates how many hosts are in an inventory group,
+    from the EC2 inventory script's cache (0 if unknown).
+    """
+    try:
+        with open(inventory_cache(name_prefix), 'r') as f:
+            return len(json.load(f).get(group, []))
+    except (IOError, OSError, ValueError):
+        return 0
+
+def inventory_cache(name_prefix=None):
+    """
+    Where the EC2 inventory script caches an
+    inventory (scoped to a Name tag prefix, if given).
+    """
+    name = 'ansible-ec2'
+    if name_prefix:
+        name += '-' + re.sub('[^A-Za-z0-9\-]', '_', name_prefix)
+    return os.path.join(INVENTORY_CACHE_DIR, name + '.cache')
@@ -0,0 +1,194 @@
+"""
+Rolling
+==============
+
+Rolls deploys through load balanced autoscaling groups.
+
+Rather than provisioning every instance in a group
+at once (which takes them all out of service while,
+for instance, uwsgi restarts), instances are deployed
+in batches. Each batch is taken out of the load
+balancer, provisioned, put back, and waited on until
+the load balancer considers it healthy again.
+
+The first batch goes on its own (it runs any
+migrations, and if it fails nothing else has been
+touched). After that, batches overlap as long as no
+more than `max_unavailable` instances are out of
+service at once, so the rollout goes as fast as the
+instances come back healthy. If a batch fails, no
+more batches are started and the rollout halts.
+
+A group with only one instance in service can't be
+rolled without taking it out of service, so it's
+deployed as usual instead.
+"""
+
+import time, threading
+from multiprocessing.pool import ThreadPool
+
+from cloud import connect, name
+from cloud.logger import context
+from cloud.manage import provision
+from cloud.manage.waiter import backoff, WaiterTimeout
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Autoscaling processes which could replace or
+# move instances out from under the rollout.
+SUSPENDED_PROCESSES = ['ReplaceUnhealthy', 'AZRebalance', 'AlarmNotification', 'ScheduledActions']
+
+# How long (in seconds) a batch has to become healthy.
+HEALTH_TIMEOUT = 600
+
+# Upper bound (in seconds) on how long a rollout may take.
+MAX_WAIT = 24 * 60 * 60
+
+class RolloutError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+def get_group(app, env, role):
+    """
+    Gets a role's autoscaling group, if it has
+    one which is behind a load balancer.
+    """
+    conn = connect.autoscale()
+    tag_name = name.instance(app, env, role)
+    next_token = None
+    while True:
+        groups = conn.get_all_groups(next_token=next_token)
+        for group in groups:
+            tags = dict((tag.key, tag.value) for tag in group.tags)
+            if tags.get('Name') == tag_name and group.load_balancers:
+                return group
+        next_token = getattr(groups, 'next_token', None)
+        if not next_token:
+            return None
+
+def batches(instance_ids, batch_size):
+    return [instance_ids[i:i + batch_size] for i in range(0, len(instance_ids), batch_size)]
+
+def roll(group, app, playbook, key_name, env, extra_vars={}, batch_size=1, max_unavailable=1, prefix=None):
+    """
+    Deploys a playbook to an autoscaling group's
+    in-service instances, in batches.
+
+    Raises a `RolloutError` if a batch fails.
+    """
+    instance_ids = sorted(instance.instance_id for instance in group.instances if instance.lifecycle_state == 'InService')
+    if not instance_ids:
+        logger.info('No instances in service in {0}, nothing to roll out to.'.format(group.name))
+        return
+
+    if len(instance_ids) == 1:
+        logger.warning('{0} has only one instance in service, so [{1}] can\'t be rolled out without downtime; deploying it as usual instead.'.format(group.name, playbook))
+        provision.provision(app, playbook, key_name, env=env, extra_vars=extra_vars, prefix=prefix)
+        return
+
+    # Keep at least one instance in service.
+    max_unavailable = max(1, min(max_unavailable, len(instance_ids) - 1))
+    batch_size = max(1, min(batch_size, max_unavailable))
+    elb_name = group.load_balancers[0]
+    to_deploy = batches(instance_ids, batch_size)
+
+    logger.info('Rolling out [{0}] to {1} instance(s) in {2} batch(es) of up to {3}, with at most {4} out of {5} at once.'.format(
+        playbook, len(instance_ids), len(to_deploy), batch_size, max_unavailable, elb_name))
+
+    state = {'unavailable': 0, 'done': 0, 'failed': None}
+    changed = threading.Condition()
+    env_context = getattr(context, 'env', None)
+
+    def run_batch(i, batch):
+        context.env = env_context
+        batch_vars = dict(extra_vars)
+        if i > 0 and 'run_migrations' in batch_vars:
+            batch_vars['run_migrations'] = 'no'
+        batch_prefix = '{0} {1}/{2}'.format(prefix or playbook, i + 1, len(to_deploy))
+
+        try:
+            deploy_batch(elb_name, batch, app, playbook, key_name, env, batch_vars, batch_prefix)
+        except Exception as e:
+            logger.exception('Batch {0}/{1} ({2}) failed: {3}'.format(i + 1, len(to_deploy), ', '.join(batch), e))
+            with changed:
+                state['failed'] = state['failed'] or e
+        finally:
+            context.env = None
+            with changed:
+                state['unavailable'] -= len(batch)
+                state['done'] += 1
+                changed.notify()
+
+    conn = connect.autoscale()
+    conn.suspend_processes(group.name, SUSPENDED_PROCESSES)
+    pool = ThreadPool(max(1, max_unavailable // batch_size))
+    try:
+        with changed:
+            for i, batch in enumerate(to_deploy):
+                # The first batch goes alone; the rest go as soon as there's room.
+                while state['failed'] is None and (state['unavailable'] + len(batch) > max_unavailable or (i > 0 and state['done'] == 0)):
+                    changed.wait(MAX_WAIT)
+                if state['failed'] is not None:
+                    break
+                state['unavailable'] += len(batch)
+                pool.apply_async(run_batch, (i, batch))
+
+            while state['unavailable'] > 0:
+                changed.wait(MAX_WAIT)
+    finally:
+        pool.close()
+        pool.join()
+        conn.resume_processes(group.name, SUSPENDED_PROCESSES)
+
+    if state['failed'] is not None:
+        error = state['failed']
+        raise RolloutError('Rollout of [{0}] to {1} halted: {2}'.format(playbook, group.name, getattr(error, 'message', None) or error))
+
+    logger.info('Rolled out [{0}] to {1}.'.format(playbook, group.name))
+
+def deploy_batch(elb_name, batch, app, playbook, key_name, env, extra_vars, prefix):
+    """
+    Takes a batch of instances out of the load balancer,
+    provisions them, and puts them back.
+    """
+    elb = connect.elb()
+
+    logger.info('Taking {0} out of {1}...'.format(', '.join(batch), elb_name))
+    elb.deregister_instances(elb_name, batch)
+
+    try:
+        provision.provision(app, playbook, key_name, env=env, extra_vars=extra_vars, prefix=prefix, limit=batch)
+    except Exception:
+        logger.warning('Leaving {0} out of {1}, since provisioning them failed.'.format(', '.join(batch), elb_name))
+        raise
+
+    logger.info('Putting {0} back into {1}...'.format(', '.join(batch), elb_name))
+    elb.register_instances(elb_name, batch)
+    wait_until_healthy(elb, elb_name, batch)
+
+def wait_until_healthy(elb, elb_name, instance_ids, timeout=HEALTH_TIMEOUT):
+    """
+    Waits until a load balancer considers
+    all of the instances to be in service.
+    """
+    deadline = time.time() + timeout
+    delays = backoff(initial=3, maximum=30)
+    delay = next(delays)
+    remaining = len(instance_ids)
+    while True:
+        states = elb.describe_instance_health(elb_name, instance_ids)
+        unhealthy = [state.instance_id for state in states if state.state != 'InService']
+        if not unhealthy:
+            logger.info('{0} in service.'.format(', '.join(instance_ids)))
+            return
+
+        if time.time() + delay > deadline:
+            raise WaiterTimeout('{0} did not come into service in {1} within {2}s.'.format(', '.join(unhealthy), elb_name, timeout))
+
+        time.sleep(delay)
+        delay = delays.send(len(unhealthy) < remaining)
+        remaining = len(unhealthy)
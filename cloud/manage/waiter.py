@@ -0,0 +1,165 @@
+"""
+Waiter
+==============
+
+Waits on long-running AWS operations.
+
+Rather than sleeping a fixed interval and
+re-describing everything on each tick, stacks
+are followed through their event stream, and
+polling backs off while nothing is happening.
+"""
+
+import time
+from boto.exception import BotoServerError
+
+from cloud import connect
+
+import logging
+logger = logging.getLogger(__name__)
+
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+class WaiterTimeout(Exception):
+    def __init__(self, message):
+        self.message = message
+
+def stack_missing(error):
+    """
+    Whether a `BotoServerError` is CloudFormation
+    reporting that the described stack doesn't exist.
+    """
+    return 'does not exist' in str(error.message)
+
+def backoff(initial=2, maximum=20, factor=1.5):
+    """
+    Generates an adaptively growing series of delays (in seconds).
+
+    Send `True` into the generator to signal that
+    progress was made, which resets the delay to `initial`::
+
+        delays = backoff()
+        delay = next(delays)
+        delay = delays.send(True)
+    """
+    delay = initial
+    while True:
+        progressed = yield delay
+        if progressed:
+            delay = initial
+        else:
+            delay = min(delay * factor, maximum)
+
+class StackWaiter(object):
+    """
+    Follows a stack's events incrementally, using the
+    last-seen event id as a cursor, so each poll only
+    fetches what is new since the previous one.
+
+    Per-resource progress is streamed to the logger.
+    """
+
+    def __init__(self, name, conn=None, initial_delay=2, max_delay=20):
+        self.name = name
+        self.conn = conn or connect.cf()
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.cursor = None
+        self.stack_id = None
+        self.status = None
+
+    def describe(self):
+        """
+        Looks up the stack by name, recording its id
+        (events remain queryable by id after deletion)
+        and its current status.
+
+        Returns None if the stack does not exist.
+        """
+        try:
+            stacks = self.conn.describe_stacks(self.name)
+        except BotoServerError as e:
+            if stack_missing(e):
+                return None
+            raise e
+        if not stacks:
+            return None
+        stack = stacks[0]
+        self.stack_id = stack.stack_id
+        self.status = stack.stack_status
+        return stack
+
+    def poll(self):
+        """
+        Fetches the events which have occurred since the cursor,
+        oldest first.
+
+        Events come back newest first, so pages are only followed
+        until the cursor is reached. On the first poll only the latest
+        page is read; anything older belongs to previous operations.
+        """
+        new_events = []
+        next_token = None
+        first_poll = self.cursor is None
+        while True:
+            events = self.conn.describe_stack_events(self.stack_id, next_token)
+            reached_cursor = False
+            for event in events:
+                if event.event_id == self.cursor:
+                    reached_cursor = True
+                    break
+                new_events.append(event)
+            next_token = getattr(events, 'next_token', None)
+            if reached_cursor or first_poll or not next_token:
+                break
+
+        if new_events:
+            self.cursor = new_events[0].event_id
+        new_events.reverse()
+        return new_events
+
+    def is_stack_event(self, event):
+        return event.resource_type == STACK_RESOURCE_TYPE and event.physical_resource_id == self.stack_id
+
+    def wait(self, pending, timeout=None):
+        """
+        Waits while the stack's status is in `pending`,
+        returning the first status outside of it.
+
+        Returns None if the stack does not exist.
+        """
+        if self.stack_id is None and self.describe() is None:
+            return None
+        if self.status not in pending:
+            return self.status
+
+        first_poll = self.cursor is None
+        started = time.time()
+        delays = backoff(self.initial_delay, self.max_delay)
+        delay = next(delays)
+        while True:
+            events = self.poll()
+            for event in events:
+                if self.is_stack_event(event):
+                    # On the first poll, older stack events may predate
+                    # the status we already have; only take the newest.
+                    self.status = event.resource_status
+                elif not first_poll:
+                    self.log(event)
+            first_poll = False
+
+            if self.status not in pending:
+                logger.info('Stack {0} is {1}.'.format(self.name, self.status))
+                return self.status
+
+            if timeout is not None and time.time() - started > timeout:
+                raise WaiterTimeout('Timed out waiting on stack {0} (status {1})'.format(self.name, self.status))
+
+            time.sleep(delay)
+            delay = delays.send(bool(events))
+
+    def log(self, event):
+        message = '[{0}] {1} ({2}): {3}'.format(self.name, event.logical_resource_id, event.resource_type, event.resource_status)
+        if event.resource_status_reason:
+            message += ' - {0}'.format(event.resource_status_reason)
+        logger.info(message)
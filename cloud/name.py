@@ -20,3 +20,6 @@ def stack(app, env):
 
 def instance(app, env, group):
     return '{app}-{env}-{group}'.format(app=app, env=env, group=group)
+
+def formations_bucket(app):
+    return '{app}-formations'.format(app=app)
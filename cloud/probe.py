@@ -0,0 +1,107 @@
+"""
+Probe
+==============
+
+Probes hosts for SSH readiness.
+
+An instance can be "running" well before its SSH
+daemon accepts connections, so rather than sleeping
+a fixed amount of time, hosts are probed until they
+answer with an SSH banner.
+
+All hosts are probed at once over non-blocking
+sockets, backing off (with jitter) between attempts.
+"""
+
+import time, random, socket, select, errno
+
+import logging
+logger = logging.getLogger(__name__)
+
+def wait_for_ssh(hosts, port=22, timeout=600, attempt_timeout=5, initial_delay=1, max_delay=15):
+    """
+    Waits until each host accepts a TCP connection
+    on `port` and sends an SSH banner, or until
+    `timeout` seconds have passed.
+
+    Returns a dict of host to whether it is ready.
+    """
+    deadline = time.time() + timeout
+    ready = set()
+    attempts = dict((host, 0) for host in hosts)
+    next_attempt = dict((host, 0) for host in hosts)
+
+    while next_attempt and time.time() < deadline:
+        now = time.time()
+        due = [host for host, at in next_attempt.items() if at <= now]
+        results = probe(due, port, min(attempt_timeout, max(deadline - now, 0.1)))
+        for host, ok in results.items():
+            if ok:
+                logger.info('{0} is accepting SSH connections.'.format(host))
+                ready.add(host)
+                del next_attempt[host]
+            else:
+                attempts[host] += 1
+                delay = min(max_delay, initial_delay * 2 ** attempts[host])
+                next_attempt[host] = time.time() + random.uniform(delay / 2.0, delay)
+
+        if next_attempt:
+            wake = min(min(next_attempt.values()), deadline)
+            time.sleep(max(0, wake - time.time()))
+
+    for host in next_attempt:
+        logger.warning('{0} did not accept SSH connections within {1}s.'.format(host, timeout))
+
+    return dict((host, host in ready) for host in hosts)
+
+def probe(hosts, port=22, timeout=5):
+    """
+    Concurrently attempts to connect to each host
+    and read an SSH banner.
+
+    Returns a dict of host to whether it succeeded.
+    """
+    results = dict((host, False) for host in hosts)
+    connecting = {}
+    reading = {}
+
+    for host in hosts:
+        try:
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(address[0], address[1], address[2])
+        except socket.error:
+            continue
+        sock.setblocking(0)
+        err = sock.connect_ex(address[4])
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            connecting[sock] = host
+        else:
+            sock.close()
+
+    deadline = time.time() + timeout
+    while (connecting or reading) and time.time() < deadline:
+        try:
+            readable, writable, _ = select.select(list(reading), list(connecting), [], max(deadline - time.time(), 0))
+        except select.error:
+            break
+
+        for sock in writable:
+            host = connecting.pop(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                reading[sock] = host
+            else:
+                sock.close()
+
+        for sock in readable:
+            host = reading.pop(sock)
+            try:
+                banner = sock.recv(256)
+            except socket.error:
+                banner = b''
+            results[host] = banner.startswith(b'SSH-')
+            sock.close()
+
+    for sock in list(connecting) + list(reading):
+        sock.close()
+
+    return results
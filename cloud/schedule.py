@@ -0,0 +1,160 @@
+"""
+Schedule
+==============
+
+Runs operations concurrently.
+
+`run` handles lifecycle operations (commission,
+update, deploy, ...) on several environments at once.
+Each environment is handled in its own worker
+thread, with at most `workers` running at a time.
+Each environment's log records also go to
+their own file, `cloud/logger/logs/<env>.log`.
+
+`run_graph` handles operations which depend on
+one another, e.g. deploying roles, running each
+as soon as everything it depends on is done.
+"""
+
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from cloud.logger import context, env_handler
+
+logger = logging.getLogger(__name__)
+
+# Upper bound (in seconds) on how long a run may take.
+MAX_WAIT = 7 * 24 * 60 * 60
+
+class Result(object):
+    def __init__(self, name):
+        self.name = name
+        self.status = 'pending'
+        self.error = None
+        self.value = None
+        self.note = None
+        self.duration = 0
+
+    @property
+    def ok(self):
+        return self.status in ['ok', 'skipped']
+
+    @property
+    def description(self):
+        return '{0} ({1})'.format(self.status, self.note) if self.note else self.status
+
+def call(name, func, *args, **kwargs):
+    """
+    Calls `func`, capturing its outcome
+    and timing as a `Result`.
+    """
+    result = Result(name)
+    started = time.time()
+    try:
+        result.value = func(*args, **kwargs)
+        result.status = 'ok'
+    except Exception as e:
+        result.error = e
+        result.status = 'failed'
+        logger.exception('{0} failed for [{1}]: {2}'.format(func.__name__, name, e))
+    finally:
+        result.duration = time.time() - started
+    return result
+
+def run(envs, func, workers=3, **kwargs):
+    """
+    Calls `func(env, **kwargs)` for each environment concurrently,
+    then logs a summary of how each went and how long it took.
+
+    Returns a list of `Result`s, in the order of `envs`.
+    """
+    root = logging.getLogger('cloud')
+    handlers = [env_handler(env) for env in envs]
+    for handler in handlers:
+        root.addHandler(handler)
+
+    def run_env(env):
+        context.env = env
+        try:
+            return call(env, func, env, **kwargs)
+        finally:
+            context.env = None
+
+    pool = ThreadPool(max(1, min(workers, len(envs))))
+    try:
+        # A timeout keeps the wait interruptible (e.g. with Ctrl-C).
+        results = pool.map_async(run_env, envs).get(MAX_WAIT)
+        pool.close()
+        pool.join()
+    finally:
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+    summarize(func.__name__, results, label='env')
+    return results
+
+def run_graph(names, dependencies, func, workers=4):
+    """
+    Calls `func(name)` for each name once all of its dependencies
+    (a dict of name to the names it depends on) have succeeded,
+    running the ones which are ready concurrently.
+
+    If one fails, everything depending on it is cancelled;
+    everything else still runs.
+
+    Returns a list of `Result`s, in the order of `names`.
+    """
+    results = dict((name, Result(name)) for name in names)
+    done = threading.Condition()
+    env = getattr(context, 'env', None)
+
+    def run_node(name):
+        context.env = env
+        try:
+            result = call(name, func, name)
+        finally:
+            context.env = None
+        with done:
+            results[name] = result
+            done.notify()
+
+    def deps(name):
+        return [dep for dep in dependencies.get(name, []) if dep in results]
+
+    pool = ThreadPool(max(1, min(workers, len(names))))
+    with done:
+        while True:
+            for name in names:
+                result = results[name]
+                if result.status != 'pending':
+                    continue
+                statuses = [results[dep].status for dep in deps(name)]
+                if any(status in ['failed', 'cancelled'] for status in statuses):
+                    logger.info('Cancelling [{0}] since something it depends on failed.'.format(name))
+                    result.status = 'cancelled'
+                elif all(status in ['ok', 'skipped'] for status in statuses):
+                    result.status = 'running'
+                    pool.apply_async(run_node, (name,))
+
+            if all(result.status not in ['pending', 'running'] for result in results.values()):
+                break
+            # A timeout keeps the wait interruptible (e.g. with Ctrl-C).
+            done.wait(MAX_WAIT)
+
+    pool.close()
+    pool.join()
+    return [results[name] for name in names]
+
+def summarize(name, results, label='name'):
+    """
+    Logs a table of each result's outcome and timing.
+    """
+    width = max([len(label)] + [len(result.name) for result in results])
+    status_width = max([9] + [len(result.description) for result in results])
+    rows = ['{0}  {1}  {2:>9}'.format(label.ljust(width), 'status'.ljust(status_width), 'duration')]
+    for result in results:
+        rows.append('{0}  {1}  {2:>8.1f}s'.format(result.name.ljust(width), result.description.ljust(status_width), result.duration))
+    logger.info('Summary ({0}):\n{1}'.format(name, '\n'.join(rows)))
@@ -0,0 +1,153 @@
+"""
+Timings
+==============
+
+Reports how long provisioning tasks take.
+
+Each playbook run records how long each of its tasks
+took on each host (see `playbooks/callback_plugins/timing.py`).
+A task's time in a run is its slowest host's time, since
+that's how long the run waited on it.
+
+The report shows the slowest tasks over recent runs and
+how they're trending, e.g. to decide what's worth baking
+into the image instead of running at deploy time.
+"""
+
+import os, json, time, itertools
+
+from cloud.logger import logs_path
+
+# Where the timings of each playbook run are written.
+TIMINGS_PATH = os.path.join(logs_path, 'timings')
+
+# How many runs' timings are kept around.
+TIMINGS_RETENTION = 500
+
+_run_ids = itertools.count(1)
+
+def run_path(playbook, env=None):
+    """
+    Creates a path for a playbook run's timings,
+    pruning the oldest runs beyond `TIMINGS_RETENTION`.
+    """
+    if not os.path.exists(TIMINGS_PATH):
+        os.makedirs(TIMINGS_PATH)
+
+    runs = sorted(f for f in os.listdir(TIMINGS_PATH) if f.endswith('.json'))
+    for filename in runs[:max(0, len(runs) - TIMINGS_RETENTION + 1)]:
+        try:
+            os.remove(os.path.join(TIMINGS_PATH, filename))
+        except OSError:
+            pass
+
+    filename = '{0}-{1}-{2:06d}-{3}-{4}.json'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), next(_run_ids), env or 'image', playbook)
+    return os.path.abspath(os.path.join(TIMINGS_PATH, filename))
+
+def load_runs(envs=None):
+    """
+    Loads recorded runs, oldest first.
+
+    If `envs` are given, only runs for those environments
+    (and image runs, which aren't for any environment) are loaded.
+    """
+    if not os.path.exists(TIMINGS_PATH):
+        return []
+
+    runs = []
+    for filename in os.listdir(TIMINGS_PATH):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(TIMINGS_PATH, filename), 'r') as f:
+                run = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if envs is None or run.get('env') is None or run.get('env') in envs:
+            runs.append(run)
+    return sorted(runs, key=lambda run: run['started'])
+
+def task_times(run):
+    """
+    Gets each task's time in a run, i.e. its slowest host's
+    time, as a dict of task to `(duration, host)`.
+    """
+    times = {}
+    for task in run['tasks']:
+        if task['status'] == 'skipped':
+            continue
+        key = (task['play'], task['task'])
+        if key not in times or task['duration'] > times[key][0]:
+            times[key] = (task['duration'], task['host'])
+    return times
+
+def report(envs=None, top=15, runs=10):
+    """
+    Summarizes the `top` slowest tasks, averaged over
+    each playbook's last `runs` runs, and the trend of
+    each (its last run against the ones before it).
+    """
+    by_playbook = {}
+    for run in load_runs(envs):
+        by_playbook.setdefault(run['playbook'], []).append(run)
+
+    if not by_playbook:
+        return 'No timings have been recorded yet.'
+
+    rows = []
+    totals = []
+    for playbook, playbook_runs in sorted(by_playbook.items()):
+        recent = playbook_runs[-runs:]
+        durations = [run['duration'] for run in recent if run.get('duration') is not None]
+        if durations:
+            totals.append((playbook, len(recent), mean(durations), durations[-1]))
+
+        history = {}
+        for run in recent:
+            for key, timing in task_times(run).items():
+                history.setdefault(key, []).append(timing)
+
+        for (play, task), timings in history.items():
+            durations = [duration for duration, host in timings]
+            rows.append({
+                'playbook': playbook,
+                'task': task,
+                'runs': len(timings),
+                'mean': mean(durations),
+                'last': durations[-1],
+                'trend': trend(durations),
+                'host': timings[-1][1]
+            })
+
+    rows = sorted(rows, key=lambda row: row['mean'], reverse=True)[:top]
+
+    lines = ['Playbook runs (last {0}):'.format(runs)]
+    width = max(len('playbook'), max(len(playbook) for playbook, _, _, _ in totals) if totals else 0)
+    lines.append('  {0}  {1:>4}  {2:>9}  {3:>9}'.format('playbook'.ljust(width), 'runs', 'mean', 'last'))
+    for playbook, count, avg, last in totals:
+        lines.append('  {0}  {1:>4}  {2:>8.1f}s  {3:>8.1f}s'.format(playbook.ljust(width), count, avg, last))
+
+    lines.append('')
+    lines.append('Slowest tasks (last {0} runs of each playbook):'.format(runs))
+    task_width = min(60, max([len('task')] + [len(row['task']) for row in rows]))
+    lines.append('  {0}  {1}  {2:>4}  {3:>9}  {4:>9}  {5:>7}  {6}'.format('playbook'.ljust(width), 'task'.ljust(task_width), 'runs', 'mean', 'last', 'trend', 'slowest host (last run)'))
+    for row in rows:
+        lines.append('  {0}  {1}  {2:>4}  {3:>8.1f}s  {4:>8.1f}s  {5:>7}  {6}'.format(
+            row['playbook'].ljust(width), row['task'][:task_width].ljust(task_width), row['runs'], row['mean'], row['last'], row['trend'], row['host']))
+
+    return '\n'.join(lines)
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+def trend(durations):
+    """
+    How a task's last run compares to
+    the mean of the runs before it.
+    """
+    if len(durations) < 2:
+        return '-'
+    previous = mean(durations[:-1])
+    if not previous:
+        return '-'
+    return '{0:+.0f}%'.format((durations[-1] - previous) / previous * 100)
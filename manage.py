@@ -1,5 +1,6 @@
-import cloud
 import argparse
+import sys
+import os
 
 if __name__ == '__main__':
 
@@ -9,7 +10,9 @@ if __name__ == '__main__':
             epilog='For info on instances, see https://aws.amazon.com/ec2/instance-types/instance-details/'
             )
 
-    parser.add_argument('env', metavar='env', type=str, help='the environment, e.g. production, qa')
+    parser.add_argument('envs', metavar='env', type=str, nargs='+', help='the environment(s), e.g. production, qa')
+    parser.add_argument('--workers', type=int, help='the maximum number of environments to operate on at once', default=3)
+    parser.add_argument('-v', '--verbose', action='count', help='ansible-playbook verbosity (repeat for more, e.g. -vvvv)', default=0)
     subparsers = parser.add_subparsers(help='management commands', dest='command')
 
     # commission
@@ -17,12 +20,15 @@ if __name__ == '__main__':
     commission_parser.add_argument('--min_size', type=int, help='the minimum autoscaling size', default=1)
     commission_parser.add_argument('--max_size', type=int, help='the maximum autoscaling size', default=4)
     commission_parser.add_argument('--instance_type', type=str, help='the instance type for the application infrastructure', default='m3.medium')
+    commission_parser.add_argument('--nested', action='store_true', help='build each formation as its own nested stack')
 
     # update
     update_parser = subparsers.add_parser('update', help='update existing infrastructure')
     update_parser.add_argument('--min_size', type=int, help='the minimum autoscaling size', default=1)
     update_parser.add_argument('--max_size', type=int, help='the maximum autoscaling size', default=4)
     update_parser.add_argument('--instance_type', type=str, help='the instance type for the application infrastructure', default='m3.medium')
+    update_parser.add_argument('--nested', action='store_true', help='build each formation as its own nested stack')
+    update_parser.add_argument('--force', action='store_true', help='push the infrastructure update even if the plan shows no changes')
 
     # decommission
     decommission_parser = subparsers.add_parser('decommission', help='decommissions infrastructure')
@@ -31,39 +37,96 @@ if __name__ == '__main__':
     roles = ['api', 'front', 'knowledge', 'collector']
     deploy_parser = subparsers.add_parser('deploy', help='deploy to infrastructure')
     deploy_parser.add_argument('--roles', type=str, nargs='+', help='the role(s) to deploy', default=roles, choices=roles)
+    deploy_parser.add_argument('--rolling', action='store_true', help='deploy load balanced autoscaling groups in batches, keeping the rest in service')
+    deploy_parser.add_argument('--batch_size', type=int, help='the number of instances deployed per batch in a rolling deploy (default: rolling_batch_size from the config, or 1)', default=None)
+    deploy_parser.add_argument('--max_unavailable', type=int, help='the maximum number of instances out of service at once in a rolling deploy (default: rolling_max_unavailable from the config, or 1)', default=None)
+    deploy_parser.add_argument('--force', action='store_true', help='deploy roles even if nothing has changed since they were last deployed')
 
     # clean
     clean_parser = subparsers.add_parser('clean', help='cleans base images and image instances')
 
+    # pool
+    pool_parser = subparsers.add_parser('pool', help='refills and trims the warm pool of image instances')
+    pool_parser.add_argument('--size', type=int, help='the number of stopped, provisioned image instances to keep (default: image_pool_size from the config, or 1)', default=None)
+
+    # report
+    report_parser = subparsers.add_parser('report', help='reports the slowest provisioning tasks and how they are trending')
+    report_parser.add_argument('--top', type=int, help='the number of tasks to show', default=15)
+    report_parser.add_argument('--runs', type=int, help='the number of recent runs of each playbook to consider', default=10)
+
     args = parser.parse_args()
 
+    # Paths (to playbooks, formations, keys...) are relative
+    # to this directory, wherever we're run from. `cloud` is
+    # only imported now, so e.g. `--help` doesn't wait on it.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import cloud
+
+    cloud.manage.provision.VERBOSITY = args.verbose
+    if args.command == 'pool' and args.size is None:
+        args.size = getattr(cloud.config, 'IMAGE_POOL_SIZE', 1)
+    if args.command == 'deploy':
+        if args.batch_size is None:
+            args.batch_size = getattr(cloud.config, 'ROLLING_BATCH_SIZE', 1)
+        if args.max_unavailable is None:
+            args.max_unavailable = getattr(cloud.config, 'ROLLING_MAX_UNAVAILABLE', 1)
+    envs = ', '.join(args.envs)
+    results = []
+
     if args.command == 'commission':
-        cloud.commission(
-            args.env,
+        results = cloud.schedule.run(
+            args.envs,
+            cloud.commission,
+            workers=args.workers,
             instance_type=args.instance_type,
             min_size=args.min_size,
-            max_size=args.max_size)
+            max_size=args.max_size,
+            nested=args.nested)
 
     elif args.command == 'update':
-        cloud.update(
-            args.env,
+        results = cloud.schedule.run(
+            args.envs,
+            cloud.update,
+            workers=args.workers,
             instance_type=args.instance_type,
             min_size=args.min_size,
-            max_size=args.max_size)
+            max_size=args.max_size,
+            force=args.force,
+            nested=args.nested)
 
     elif args.command == 'decommission':
-        confirm = raw_input('This will dismantle the application infrastructure for [{0}]. Are you sure? '.format(args.env))
+        confirm = raw_input('This will dismantle the application infrastructure for [{0}]. Are you sure? '.format(envs))
         if confirm.lower() in ['y', 'yes', 'yeah', 'ya', 'aye']:
-            cloud.decommission(args.env)
+            results = cloud.schedule.run(args.envs, cloud.decommission, workers=args.workers)
         else:
             print('Exiting.')
 
     elif args.command == 'deploy':
-        cloud.deploy(args.env, roles=args.roles)
+        results = cloud.schedule.run(
+            args.envs,
+            cloud.deploy,
+            workers=args.workers,
+            roles=args.roles,
+            force=args.force,
+            rolling=args.rolling,
+            batch_size=args.batch_size,
+            max_unavailable=args.max_unavailable)
 
     elif args.command == 'clean':
-        confirm = raw_input('This will delete the base image for [{0}]. Are you sure? '.format(args.env))
+        confirm = raw_input('This will delete the base image for [{0}]. Are you sure? '.format(envs))
         if confirm.lower() in ['y', 'yes', 'yeah', 'ya', 'aye']:
             cloud.clean()
         else:
             print('Exiting.')
+
+    elif args.command == 'pool':
+        cloud.pool(args.size)
+
+    elif args.command == 'report':
+        print(cloud.timings.report(args.envs, top=args.top, runs=args.runs))
+
+    cloud.connect.log_stats()
+    cloud.api.log_stats()
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
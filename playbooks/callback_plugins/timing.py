@@ -0,0 +1,123 @@
+"""
+Timing
+==============
+
+An Ansible callback plugin which records how
+long each task takes on each host.
+
+`cloud.manage.provision` tells Ansible where to find this
+plugin and, with the `CLOUD_TIMINGS_PATH` environment variable,
+where to write; without that variable it does nothing.
+
+Each playbook run is written as a JSON file,
+which `manage.py <env> report` summarizes.
+
+With more than one fork, Ansible runs tasks (and so the
+`runner_on_*` callbacks) in forked worker processes,
+so each task's timing is appended as a line to a side
+file (`<path>.tasks`) rather than kept in memory, and
+merged into the run when the playbook finishes.
+
+Ansible sets `play` and `task` on every callback
+plugin, so the current ones are kept under other names.
+"""
+
+import os
+import json
+import time
+
+class CallbackModule(object):
+    def __init__(self):
+        self.path = os.environ.get('CLOUD_TIMINGS_PATH')
+        self.tasks_path = '{0}.tasks'.format(self.path) if self.path else None
+        self.run = {
+            'playbook': os.environ.get('CLOUD_TIMINGS_PLAYBOOK'),
+            'env': os.environ.get('CLOUD_TIMINGS_ENV') or None,
+            'started': time.time(),
+            'duration': None,
+            'tasks': []
+        }
+        self.play_name = None
+        self.task_name = None
+        self.task_started = None
+
+    def start_task(self, name):
+        self.task_name = name
+        self.task_started = time.time()
+
+    def record(self, host, status):
+        if self.path is None or self.task_name is None:
+            return
+        line = json.dumps({
+            'play': self.play_name,
+            'task': self.task_name,
+            'host': host,
+            'status': status,
+            'duration': round(time.time() - self.task_started, 3)
+        }) + '\n'
+
+        # A single append is atomic, so concurrent
+        # workers' lines don't get interleaved.
+        fd = os.open(self.tasks_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def load_tasks(self):
+        """
+        Reads the recorded tasks back from the side file.
+        """
+        tasks = []
+        try:
+            with open(self.tasks_path, 'r') as f:
+                for line in f:
+                    try:
+                        tasks.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except (IOError, OSError):
+            pass
+        return tasks
+
+    def playbook_on_play_start(self, name):
+        self.play_name = name
+
+    def playbook_on_setup(self):
+        self.start_task('gather facts')
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self.start_task(name)
+
+    def playbook_on_handler_task_start(self, name):
+        self.start_task('handler: {0}'.format(name))
+
+    def runner_on_ok(self, host, res):
+        self.record(host, 'ok')
+
+    def runner_on_failed(self, host, res, ignore_errors=False):
+        self.record(host, 'ignored' if ignore_errors else 'failed')
+
+    def runner_on_skipped(self, host, item=None):
+        self.record(host, 'skipped')
+
+    def runner_on_unreachable(self, host, res):
+        self.record(host, 'unreachable')
+
+    def playbook_on_stats(self, stats):
+        if self.path is None:
+            return
+        self.run['duration'] = round(time.time() - self.run['started'], 3)
+        self.run['tasks'] = self.load_tasks()
+
+        # Write to a temporary file first, so a
+        # report never reads a half-written run.
+        tmp_path = '{0}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.run, f)
+        os.rename(tmp_path, self.path)
+
+        try:
+            os.remove(self.tasks_path)
+        except OSError:
+            pass
@@ -24,6 +24,15 @@ you need to define:
 
 For more details, see: http://docs.pythonboto.org/en/latest/boto_config_tut.html
 
+To only get the hosts whose Name tag starts with a prefix (e.g. one app's
+environment), set 'name_prefix' in ec2.ini or define the EC2_NAME_PREFIX
+environment variable:
+
+    export EC2_NAME_PREFIX=argos-staging-
+
+The filter is applied by EC2 itself, and scoped inventories are cached
+separately from the unscoped one.
+
 When run against a specific host, this script returns the following variables:
  - ec2_ami_launch_index
  - ec2_architecture
@@ -117,7 +126,11 @@ import sys
 import os
 import argparse
 import re
+import hashlib
+import threading
 from time import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import boto
 from boto import ec2
 from boto import rds
@@ -132,6 +145,15 @@ except ImportError:
 
 
 class Ec2Inventory(object):
+    # The EC2 filters matching each destination variable, so an instance can
+    # be looked up by its address.
+    destination_filters = {
+        'public_dns_name': 'dns-name',
+        'private_dns_name': 'private-dns-name',
+        'ip_address': 'ip-address',
+        'private_ip_address': 'private-ip-address'
+    }
+
     def _empty_inventory(self):
         return {"_meta" : {"hostvars" : {}}}
 
@@ -145,6 +167,16 @@ class Ec2Inventory(object):
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Whether the inventory was fetched from AWS (rather than the cache)
+        self.refreshed = False
+
+        # The AWS account id and cached RDS tags, which are shared by the
+        # threads scanning each region
+        self.account_id = None
+        self.rds_tags = None
+        self.lock = threading.Lock()
+        self.connections = threading.local()
+
         # Read settings and parse CLI arguments
         self.read_settings()
         self.parse_cli_args()
@@ -161,7 +193,7 @@ class Ec2Inventory(object):
 
         elif self.args.list:
             # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
+            if self.inventory == self._empty_inventory() and not self.refreshed:
                 data_to_print = self.get_inventory_from_cache()
             else:
                 data_to_print = self.json_format_dict(self.inventory, True)
@@ -223,15 +255,46 @@ class Ec2Inventory(object):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
 
+        # Scoping by Name tag
+        self.name_prefix = None
+        if config.has_option('ec2', 'name_prefix'):
+            self.name_prefix = config.get('ec2', 'name_prefix') or None
+        if os.environ.get('EC2_NAME_PREFIX'):
+            self.name_prefix = os.environ['EC2_NAME_PREFIX']
+
         # Cache related
         cache_dir = os.path.expanduser(config.get('ec2', 'cache_path'))
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
-        self.cache_path_cache = cache_dir + "/ansible-ec2.cache"
-        self.cache_path_index = cache_dir + "/ansible-ec2.index"
+        cache_name = "ansible-ec2"
+        if self.name_prefix:
+            cache_name += "-" + self.to_safe(self.name_prefix)
+        self.cache_path_cache = cache_dir + "/" + cache_name + ".cache"
+        self.cache_path_index = cache_dir + "/" + cache_name + ".index"
+
+        # The account id and RDS tags are cached across runs (and scopes).
+        # The account id is cached per access key, so switching credentials
+        # doesn't reuse another account's id.
+        self.cache_path_account = cache_dir + "/ansible-ec2-%s.account"
+        self.cache_path_rds_tags = cache_dir + "/ansible-ec2.rds-tags"
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        # Region scanning
+        self.region_timeout = 30
+        if config.has_option('ec2', 'region_timeout'):
+            self.region_timeout = config.getint('ec2', 'region_timeout')
+        self.region_workers = 32
+        if config.has_option('ec2', 'region_workers'):
+            self.region_workers = config.getint('ec2', 'region_workers')
+
+        # RDS tags
+        self.rds_tag_workers = 8
+        if config.has_option('ec2', 'rds_tag_workers'):
+            self.rds_tag_workers = config.getint('ec2', 'rds_tag_workers')
+        self.rds_tags_max_age = 86400
+        if config.has_option('ec2', 'rds_tags_max_age'):
+            self.rds_tags_max_age = config.getint('ec2', 'rds_tags_max_age')
 
 
     def parse_cli_args(self):
@@ -253,14 +316,72 @@ class Ec2Inventory(object):
         if self.route53_enabled:
             self.get_route53_records()
 
+        results, failed = self.scan_regions()
+        self.refreshed = True
+
+        if self.rds_tags is not None:
+            with self.lock:
+                self.write_to_cache(self.rds_tags, self.cache_path_rds_tags)
+
+        # Merge in a fixed order, so the inventory doesn't depend
+        # on which region happened to answer first.
         for region in self.regions:
-            self.get_instances_by_region(region)
-            self.get_rds_instances_by_region(region)
+            if region not in results:
+                continue
+            instances, rds_instances = results[region]
+            for instance in instances:
+                self.add_instance(instance, region)
+            for instance in rds_instances:
+                self.add_rds_instance(instance, region)
+
+        if failed:
+            for region in self.regions:
+                if region in failed:
+                    sys.stderr.write("Couldn't scan region %s, its hosts are missing from the inventory: %s\n" % (region, failed[region]))
+            if not results:
+                sys.exit(1)
+
+            # Don't cache partial results, so that the next run tries again.
+            return
 
         self.write_to_cache(self.inventory, self.cache_path_cache)
         self.write_to_cache(self.index, self.cache_path_index)
 
 
+    def scan_regions(self):
+        ''' Scans all of the regions at once, each in its own thread, so a
+        refresh takes as long as the slowest region rather than all of them
+        together. Regions which take longer than region_timeout seconds are
+        given up on. Returns a dict of region to its (EC2, RDS) instances,
+        and a dict of region to the error for regions which failed. '''
+
+        pool = ThreadPool(max(1, min(self.region_workers, len(self.regions))))
+        pending = dict((region, pool.apply_async(self.scan_region, (region,))) for region in self.regions)
+        pool.close()
+
+        deadline = time() + self.region_timeout
+        results = {}
+        failed = {}
+        for region in self.regions:
+            try:
+                results[region] = pending[region].get(max(0, deadline - time()))
+            except TimeoutError:
+                failed[region] = 'timed out after %ss' % self.region_timeout
+            except Exception, e:
+                failed[region] = e
+
+        # Worker threads are daemonic, so any still stuck
+        # on a region which timed out won't hold up exiting.
+        return results, failed
+
+
+    def scan_region(self, region):
+        ''' Gets a region's EC2 and RDS instances '''
+
+        return (self.get_instances_by_region(region),
+                self.get_rds_instances_by_region(region))
+
+
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
         region '''
@@ -274,66 +395,164 @@ class Ec2Inventory(object):
 
             # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
             if conn is None:
-                print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-                sys.exit(1)
+                raise Exception("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
 
-            reservations = conn.get_all_instances()
+            instances = []
+            reservations = conn.get_all_instances(filters=self.instance_filters())
             for reservation in reservations:
-                for instance in reservation.instances:
-                    self.add_instance(instance, region)
+                instances.extend(reservation.instances)
+            return sorted(instances, key=lambda instance: instance.id)
 
         except boto.exception.BotoServerError, e:
-            if  not self.eucalyptus:
-                print "Looks like AWS is down again:"
-            print e
-            sys.exit(1)
+            if not self.eucalyptus:
+                raise Exception("Looks like AWS is down again: %s" % e)
+            raise
+
+    def instance_filters(self):
+        ''' The filters EC2 applies to the instances it returns: only running
+        instances (the only ones added anyway) and, if scoped, only those
+        whose Name tag starts with name_prefix '''
+
+        if self.eucalyptus:
+            return None
+
+        filters = {'instance-state-name': 'running'}
+        if self.name_prefix:
+            filters['tag:Name'] = self.name_prefix + '*'
+        return filters
+
+
+    def in_scope(self, tags):
+        ''' Whether a resource with these tags is in the inventory's scope '''
+
+        return not self.name_prefix or tags.get('Name', '').startswith(self.name_prefix)
+
 
     def get_rds_instances_by_region(self, region):
-	''' Makes an AWS API call to the list of RDS instances in a particular
+        ''' Makes an AWS API call to the list of RDS instances in a particular
         region '''
 
-        # Hack to get the AWS account id.
-        # Amazon does not provide any easy way to get it.
-        ec2_conn = ec2.connect_to_region(region)
-        sg = ec2_conn.get_all_security_groups()
-        account_id = sg[0].owner_id
-
+        rds_instances = []
         try:
             conn = rds.connect_to_region(region)
-            conn2 = rds2.connect_to_region(region) # To get RDS tags.
             if conn:
                 instances = conn.get_all_dbinstances()
+
+                # NOTE: Boto 2.27.0 (latest as of 3/24/2014)
+                # is not able to get tags from RDS instances
+                # in a way like it can get EC2 tags.
+                # Until there is a better solution, the following works.
+                tags = self.get_rds_tags(region, instances)
+
                 for instance in instances:
+                    instance.tags = tags[self.rds_arn(region, instance)]
 
-                    # NOTE: Boto 2.27.0 (latest as of 3/24/2014)
-                    # is not able to get tags from RDS instances
-                    # in a way like it can get EC2 tags.
-                    # Until there is a better solution, the following works.
-
-                    # Construct the ARN for this RDS instance,
-                    # so we can get its tags.
-                    arn = ':'.join([
-                        'arn',
-                        'aws',
-                        'rds',
-                        region,
-                        account_id,
-                        'db',
-                        instance.id
-                    ])
-
-                    # Get its raw tagset and
-                    # standardize it to the way Boto presents
-                    # EC2 tags.
-                    tagset = conn2.list_tags_for_resource(arn)['ListTagsForResourceResponse']['ListTagsForResourceResult']['TagList']
-                    instance.tags = {tag['Key']: tag['Value'] for tag in tagset}
-
-                    self.add_rds_instance(instance, region)
+                    # RDS can't filter by tag, so scope them here.
+                    if self.in_scope(instance.tags):
+                        rds_instances.append(instance)
         except boto.exception.BotoServerError, e:
             if not e.reason == "Forbidden":
-                print "Looks like AWS RDS is down: "
-                print e
-                sys.exit(1)
+                raise Exception("Looks like AWS RDS is down: %s" % e)
+
+        return sorted(rds_instances, key=lambda instance: instance.id)
+
+
+    def get_account_id(self, region):
+        ''' Gets the AWS account id, which is cached across runs (per access
+        key) since it never changes '''
+
+        with self.lock:
+            if self.account_id is not None:
+                return self.account_id
+
+            ec2_conn = ec2.connect_to_region(region)
+            access_key = hashlib.sha1(ec2_conn.aws_access_key_id or '').hexdigest()[:16]
+            cache_path = self.cache_path_account % access_key
+            if os.path.isfile(cache_path):
+                self.account_id = open(cache_path, 'r').read().strip() or None
+                if self.account_id is not None:
+                    return self.account_id
+
+            # Hack to get the AWS account id.
+            # Amazon does not provide any easy way to get it.
+            sg = ec2_conn.get_all_security_groups()
+            self.account_id = sg[0].owner_id
+
+            cache = open(cache_path, 'w')
+            cache.write(self.account_id)
+            cache.close()
+            return self.account_id
+
+
+    def rds_arn(self, region, instance):
+        ''' Constructs the ARN for an RDS instance, so we can get its tags '''
+
+        return ':'.join([
+            'arn',
+            'aws',
+            'rds',
+            region,
+            self.get_account_id(region),
+            'db',
+            instance.id
+        ])
+
+
+    def get_rds_tags(self, region, instances):
+        ''' Gets the tags of a region's RDS instances, as a dict of ARN to
+        tags. Tags are cached per ARN, and only fetched again when the
+        region's set of instances changes (or the cache gets too old), in
+        which case they're fetched concurrently '''
+
+        arns = sorted(self.rds_arn(region, instance) for instance in instances)
+
+        with self.lock:
+            if self.rds_tags is None:
+                self.rds_tags = {'regions': {}, 'tags': {}}
+
+                # An explicit refresh fetches every tag again, e.g. after
+                # an RDS instance is retagged.
+                if not self.args.refresh_cache and os.path.isfile(self.cache_path_rds_tags):
+                    try:
+                        self.rds_tags = json.loads(open(self.cache_path_rds_tags, 'r').read())
+                    except ValueError:
+                        pass
+
+            cached = self.rds_tags['regions'].get(region)
+            if cached and cached['arns'] == arns and cached['fetched'] + self.rds_tags_max_age > time():
+                return dict((arn, self.rds_tags['tags'][arn]) for arn in arns)
+
+        tags = {}
+        if arns:
+            pool = ThreadPool(max(1, min(self.rds_tag_workers, len(arns))))
+            try:
+                tags = dict(zip(arns, pool.map(lambda arn: self.get_rds_tags_for_arn(region, arn), arns)))
+            finally:
+                pool.close()
+                pool.join()
+
+        with self.lock:
+            for arn in (cached or {}).get('arns', []):
+                self.rds_tags['tags'].pop(arn, None)
+            self.rds_tags['tags'].update(tags)
+            self.rds_tags['regions'][region] = {'arns': arns, 'fetched': time()}
+
+        return tags
+
+
+    def get_rds_tags_for_arn(self, region, arn):
+        ''' Makes an AWS API call to get an RDS instance's tags '''
+
+        # Connections aren't shared across threads.
+        connections = self.connections.__dict__.setdefault('rds2', {})
+        if region not in connections:
+            connections[region] = rds2.connect_to_region(region)
+
+        # Get its raw tagset and
+        # standardize it to the way Boto presents
+        # EC2 tags.
+        tagset = connections[region].list_tags_for_resource(arn)['ListTagsForResourceResponse']['ListTagsForResourceResult']['TagList']
+        return dict((tag['Key'], tag['Value']) for tag in tagset)
 
     def get_instance(self, region, instance_id):
         ''' Gets details about a specific instance '''
@@ -571,24 +790,112 @@ class Ec2Inventory(object):
         return instance_vars
 
     def get_host_info(self):
-        ''' Get variables about a specific host '''
+        ''' Get variables about a specific host, from the cached inventory's
+        hostvars, only going to AWS if the host isn't in the cache '''
 
-        if len(self.index) == 0:
-            # Need to load index from cache
-            self.load_index_from_cache()
+        if self.inventory == self._empty_inventory() and not self.refreshed:
+            self.inventory = json.loads(self.get_inventory_from_cache())
 
-        if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
-                # host migh not exist anymore
-                return self.json_format_dict({}, True)
+        hostvars = self.inventory.get('_meta', {}).get('hostvars', {})
+        if self.args.host in hostvars:
+            return self.json_format_dict(hostvars[self.args.host], True)
 
-        (region, instance_id) = self.index[self.args.host]
+        # Hosts which are in the inventory without hostvars (RDS instances)
+        # have none to give, so there's no point looking them up.
+        if self.is_cached_host(self.args.host):
+            return self.json_format_dict({}, True)
 
-        instance = self.get_instance(region, instance_id)
+        # host migh not exist anymore, or might be new since the cache was made
+        instance = self.find_instance(self.args.host)
+        if instance is None:
+            return self.json_format_dict({}, True)
         return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
 
+
+    def is_cached_host(self, host):
+        ''' Whether a host is in the (cached) index or inventory '''
+
+        if len(self.index) == 0 and os.path.isfile(self.cache_path_index):
+            self.load_index_from_cache()
+        if host in self.index:
+            return True
+
+        for key, hosts in self.inventory.iteritems():
+            if isinstance(hosts, list) and host in hosts:
+                return True
+        return False
+
+
+    def find_instance(self, host):
+        ''' Looks up a host missing from the cache by its destination address,
+        in each region it could be in (usually only one, from its hostname)
+        at once. Only running EC2 instances have host vars, so RDS endpoints
+        aren't looked up '''
+
+        if self.eucalyptus or host.endswith('.rds.amazonaws.com'):
+            return None
+
+        # IP addresses can only match the IP filters, and names the DNS ones.
+        is_ip = re.match(r'^\d+\.\d+\.\d+\.\d+$', host) is not None
+        attributes = set([self.destination_variable, self.vpc_destination_variable])
+        filter_names = sorted(self.destination_filters[attribute] for attribute in attributes
+                              if attribute in self.destination_filters
+                              and self.destination_filters[attribute].endswith('ip-address') == is_ip)
+        if not filter_names:
+            return None
+
+        regions = self.host_regions(host)
+        pool = ThreadPool(max(1, min(self.region_workers, len(regions))))
+        pending = dict((region, pool.apply_async(self.find_instance_in_region, (region, host, filter_names))) for region in regions)
+        pool.close()
+
+        deadline = time() + self.region_timeout
+        for region in regions:
+            try:
+                instance = pending[region].get(max(0, deadline - time()))
+            except TimeoutError:
+                sys.stderr.write("ec2.py: timed out looking up %s in %s\n" % (host, region))
+                continue
+            except Exception, e:
+                sys.stderr.write("ec2.py: couldn't look up %s in %s: %s\n" % (host, region, e))
+                continue
+            if instance is not None:
+                return instance
+
+        return None
+
+
+    def find_instance_in_region(self, region, host, filter_names):
+        ''' Makes AWS API calls (one per filter, usually only one) to find a
+        running instance by its address in a region '''
+
+        conn = ec2.connect_to_region(region)
+        if conn is None:
+            return None
+
+        for filter_name in filter_names:
+            filters = dict(self.instance_filters())
+            filters[filter_name] = host
+            for reservation in conn.get_all_instances(filters=filters):
+                for instance in reservation.instances:
+                    if instance.state == 'running':
+                        return instance
+
+        return None
+
+
+    def host_regions(self, host):
+        ''' The regions a host could be in: the one in its EC2 hostname, if it
+        has one, otherwise all of them '''
+
+        if host.endswith('.compute-1.amazonaws.com') or host.endswith('.ec2.internal'):
+            return ['us-east-1']
+        match = re.search(r'\.([a-z]{2}-[a-z]+-\d)\.compute\.(amazonaws\.com|internal)$', host)
+        if match:
+            return [match.group(1)]
+        return self.regions
+
+
     def push(self, my_dict, key, element):
         ''' Pushed an element onto an array that may not have been defined in
         the dict '''
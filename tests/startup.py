@@ -0,0 +1,56 @@
+"""
+Startup
+==============
+
+Benchmarks how long the CLI takes to start.
+
+Runs `manage.py --help` and `import cloud` in fresh
+interpreters (from another directory, to check that
+neither depends on the working directory) and fails
+if either's median time goes over its budget::
+
+    $ python tests/startup.py
+    $ python tests/startup.py --runs 10 --help-budget 0.3
+"""
+
+import os, sys, time, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def timed(args, cwd, env):
+    """
+    Times a fresh interpreter running `args`.
+    """
+    started = time.time()
+    subprocess.check_call([sys.executable] + args, cwd=cwd, env=env, stdout=open(os.devnull, 'w'))
+    return time.time() - started
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark CLI startup time.')
+    parser.add_argument('--runs', type=int, help='how many times to run each', default=5)
+    parser.add_argument('--help-budget', type=float, help='the most `manage.py --help` may take (in seconds)', default=0.5)
+    parser.add_argument('--import-budget', type=float, help='the most `import cloud` may take (in seconds)', default=1.5)
+    args = parser.parse_args()
+
+    cwd = tempfile.gettempdir()
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    benchmarks = [
+        ('manage.py --help', [os.path.join(ROOT, 'manage.py'), '--help'], args.help_budget),
+        ('import cloud', ['-c', 'import cloud'], args.import_budget)
+    ]
+
+    over = False
+    for name, command, budget in benchmarks:
+        # Warm up (e.g. compile bytecode) first.
+        timed(command, cwd, env)
+        times = [timed(command, cwd, env) for _ in range(args.runs)]
+        ok = median(times) <= budget
+        over = over or not ok
+        print('{0:<20} median {1:.3f}s  min {2:.3f}s  max {3:.3f}s  (budget {4:.3f}s) {5}'.format(
+            name, median(times), min(times), max(times), budget, 'ok' if ok else 'OVER BUDGET'))
+
+    sys.exit(1 if over else 0)
@@ -0,0 +1,78 @@
+"""
+Timing
+==============
+
+Checks that the timing callback plugin
+(`playbooks/callback_plugins/timing.py`) records
+every task on every host, including when Ansible
+runs them in forked workers (i.e. with several
+hosts and forks), and fails if any are missing::
+
+    $ python tests/timing.py
+    $ python tests/timing.py --hosts 8 --forks 4
+
+The hosts are all this machine, over a local
+connection, so nothing else needs to be set up.
+"""
+
+import os, sys, json, shutil, argparse, tempfile, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALLBACK_PLUGINS_DIR = os.path.join(ROOT, 'playbooks', 'callback_plugins')
+
+PLAYBOOK = """
+- hosts: all
+  gather_facts: yes
+  tasks:
+    - name: runs
+      command: sleep 0.1
+    - name: is skipped
+      command: 'true'
+      when: false
+"""
+
+TASKS = [('gather facts', 'ok'), ('runs', 'ok'), ('is skipped', 'skipped')]
+
+ANSIBLE_CONFIG = """[defaults]
+forks = {forks}
+callback_plugins = {callback_plugins_dir}
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check that task timings are recorded for every host.')
+    parser.add_argument('--hosts', type=int, help='how many hosts to run on', default=3)
+    parser.add_argument('--forks', type=int, help='how many forks to run with', default=5)
+    parser.add_argument('--ansible-playbook', help='the ansible-playbook to run', default='ansible-playbook')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        hosts = ['host{0}'.format(i) for i in range(args.hosts)]
+        with open(os.path.join(tmp_dir, 'hosts'), 'w') as f:
+            for host in hosts:
+                f.write('{0} ansible_connection=local ansible_python_interpreter={1}\n'.format(host, sys.executable))
+        with open(os.path.join(tmp_dir, 'check.yml'), 'w') as f:
+            f.write(PLAYBOOK)
+        with open(os.path.join(tmp_dir, 'ansible.cfg'), 'w') as f:
+            f.write(ANSIBLE_CONFIG.format(forks=args.forks, callback_plugins_dir=CALLBACK_PLUGINS_DIR))
+
+        path = os.path.join(tmp_dir, 'run.json')
+        env = dict(os.environ,
+            ANSIBLE_CONFIG=os.path.join(tmp_dir, 'ansible.cfg'),
+            CLOUD_TIMINGS_PATH=path,
+            CLOUD_TIMINGS_PLAYBOOK='check')
+        subprocess.check_call([args.ansible_playbook, '-i', 'hosts', 'check.yml'], cwd=tmp_dir, env=env, stdout=open(os.devnull, 'w'))
+
+        with open(path, 'r') as f:
+            run = json.load(f)
+        recorded = set((task['task'], task['status'], task['host']) for task in run['tasks'])
+        expected = set((task, status, host) for task, status in TASKS for host in hosts)
+        missing = sorted(expected - recorded)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{0} of {1} task timings recorded ({2} hosts, {3} forks) {4}'.format(
+        len(expected) - len(missing), len(expected), args.hosts, args.forks, 'ok' if not missing else 'MISSING'))
+    for task, status, host in missing:
+        print('  missing: {0} ({1}) on {2}'.format(task, status, host))
+    sys.exit(1 if missing else 0)